@@ -1,5 +1,6 @@
 """APK Modifier Service - FastAPI 应用入口"""
 
+import asyncio
 import logging
 from contextlib import asynccontextmanager
 from pathlib import Path
@@ -10,18 +11,29 @@ from fastapi.responses import FileResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
 
 from app.routers.apk_router import router as apk_router
+from app.routers.task_router import TASK_WORKERS, task_worker
 from app.routers.task_router import router as task_router
+from app.services.apk_processor import wait_for_discards
 
 logger = logging.getLogger(__name__)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    """应用启动时确保数据目录存在"""
+    """应用启动时确保数据目录存在、清理残留工作目录并启动任务 worker，关闭时停止 worker"""
     from app import state
 
     state.storage._ensure_directories()
+    # 清理上次运行中未来得及后台删除的失败任务工作目录
+    await asyncio.get_running_loop().run_in_executor(None, state.storage.purge_trash)
+
+    state.task_queue = asyncio.Queue()
+    workers = [asyncio.create_task(task_worker()) for _ in range(TASK_WORKERS)]
     yield
+    for worker in workers:
+        worker.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+    await wait_for_discards()
 
 
 app = FastAPI(
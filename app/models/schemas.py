@@ -83,6 +83,12 @@ class TaskSummary(BaseModel):
     completed_at: Optional[datetime] = None
 
 
+class TaskListResponse(BaseModel):
+    """APK 关联任务列表响应"""
+
+    tasks: list[TaskSummary]
+
+
 # === 文件浏览模型 ===
 
 
@@ -96,6 +102,18 @@ class FileNode(BaseModel):
     size: Optional[int] = None
 
 
+class FileTreeResponse(BaseModel):
+    """APK 文件树响应"""
+
+    files: list[FileNode]
+
+
+class FileContentResponse(BaseModel):
+    """APK 内部文件内容响应"""
+
+    content: str
+
+
 # === APK 模型 ===
 
 
@@ -125,6 +143,12 @@ class APKInfo(BaseModel):
     task_count: int
 
 
+class APKListResponse(BaseModel):
+    """已上传 APK 列表响应"""
+
+    apks: list[APKInfo]
+
+
 # === 规则验证结果 ===
 
 
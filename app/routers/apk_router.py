@@ -2,14 +2,27 @@
 
 from __future__ import annotations
 
+import os
+import shutil
 from datetime import datetime, timezone
 from typing import Optional
 
 from fastapi import APIRouter, UploadFile
-from fastapi.responses import JSONResponse
-
-from app.models.schemas import APKInfo, APKUploadResponse, CacheStatus, TaskSummary, TaskStatus
+from fastapi.responses import JSONResponse, Response
+
+from app.models.schemas import (
+    APKInfo,
+    APKListResponse,
+    APKUploadResponse,
+    CacheStatus,
+    FileContentResponse,
+    FileTreeResponse,
+    TaskListResponse,
+    TaskStatus,
+    TaskSummary,
+)
 from app import state
+from app.services.storage_service import FileTooLargeError
 
 router = APIRouter(prefix="/api/v1/apks", tags=["apks"])
 
@@ -34,21 +47,15 @@ def _error_response(status_code: int, code: str, message: str, details: dict | N
 @router.post("", response_model=APKUploadResponse)
 async def upload_apk(file: UploadFile):
     """上传 APK 文件，存储并立即反编译到缓存。"""
-    # Read content and check file size
-    content = await file.read()
-    if len(content) > MAX_FILE_SIZE:
+    # Stream the upload to disk (validates size and APK format internally)
+    try:
+        apk_id = await state.storage.save_upload(file, max_size=MAX_FILE_SIZE)
+    except FileTooLargeError:
         return _error_response(
             413,
             "FILE_TOO_LARGE",
             f"文件大小超过限制，最大允许 {MAX_FILE_SIZE // (1024 * 1024)} MB",
         )
-
-    # Reset file position so save_upload can read it again
-    await file.seek(0)
-
-    # Save the uploaded file (validates APK format internally)
-    try:
-        apk_id = await state.storage.save_upload(file)
     except ValueError as e:
         return _error_response(400, "INVALID_APK_FORMAT", str(e))
     except Exception as e:
@@ -61,19 +68,14 @@ async def upload_apk(file: UploadFile):
     try:
         await state.processor.decompile_to_cache(apk_path, cache_dir)
     except RuntimeError as e:
-        # Decompile failed — clean up the stored APK file
-        apk_path = state.storage.get_apk_path(apk_id)
-        if apk_path.exists():
-            apk_path.unlink()
-        # Also clean up partial cache
-        import shutil
-        if cache_dir.exists():
-            shutil.rmtree(cache_dir, ignore_errors=True)
+        # Decompile failed — clean up the stored APK file and any partial cache
+        apk_path.unlink(missing_ok=True)
+        shutil.rmtree(cache_dir, ignore_errors=True)
         return _error_response(500, "DECOMPILE_ERROR", str(e))
 
     # Store metadata
     filename = file.filename or f"{apk_id}.apk"
-    size = len(content)
+    size = apk_path.stat().st_size
     now = datetime.now(tz=timezone.utc)
 
     state.apk_metadata[apk_id] = {
@@ -81,6 +83,8 @@ async def upload_apk(file: UploadFile):
         "cache_status": CacheStatus.READY,
         "size": size,
         "uploaded_at": now,
+        # Resolved once here so file reads don't re-resolve it on every request
+        "decompiled_root": os.path.realpath(cache_dir / "decompiled"),
     }
 
     return APKUploadResponse(
@@ -91,7 +95,7 @@ async def upload_apk(file: UploadFile):
     )
 
 
-@router.get("")
+@router.get("", response_model=APKListResponse)
 async def list_apks():
     """获取已上传 APK 列表。"""
     raw_apks = state.storage.list_apks()
@@ -101,21 +105,16 @@ async def list_apks():
         apk_id = apk["apk_id"]
         meta = state.apk_metadata.get(apk_id, {})
 
-        # Count tasks associated with this APK
-        task_count = sum(
-            1 for t in state.tasks.values() if t.get("apk_id") == apk_id
-        )
-
-        result.append(APKInfo(
+        result.append(APKInfo.model_construct(
             apk_id=apk_id,
             filename=meta.get("filename", apk["filename"]),
             size=apk["size"],
             uploaded_at=apk["uploaded_at"],
             cache_status=meta.get("cache_status", CacheStatus.READY),
-            task_count=task_count,
+            task_count=len(state.tasks_by_apk.get(apk_id, ())),
         ))
 
-    return {"apks": result}
+    return APKListResponse.model_construct(apks=result)
 
 
 @router.delete("/{apk_id}")
@@ -126,22 +125,20 @@ async def delete_apk(apk_id: str):
     if not state.storage.file_exists(apk_path):
         return _error_response(404, "APK_NOT_FOUND", f"APK {apk_id} 不存在")
 
-    # Gather associated task IDs
-    task_ids = [
-        tid for tid, t in state.tasks.items() if t.get("apk_id") == apk_id
-    ]
+    # Drop the task records first so queued jobs for this APK skip instead of
+    # cloning a cache that is being deleted; the ids tell storage what to remove
+    task_ids = state.remove_apk_tasks(apk_id)
 
     # Delete from storage
     await state.storage.delete_apk(apk_id, task_ids)
 
     # Clean up in-memory metadata
     state.apk_metadata.pop(apk_id, None)
-    for tid in task_ids:
-        state.tasks.pop(tid, None)
+    state.file_tree_cache.pop(apk_id, None)
 
     return {"success": True}
 
-@router.get("/{apk_id}/files")
+@router.get("/{apk_id}/files", response_model=FileTreeResponse)
 async def list_apk_files(apk_id: str):
     """浏览 APK 文件结构（从缓存读取）。"""
     if apk_id not in state.apk_metadata:
@@ -151,12 +148,17 @@ async def list_apk_files(apk_id: str):
     if meta.get("cache_status") != CacheStatus.READY:
         return _error_response(409, "CACHE_NOT_READY", "APK 缓存尚未就绪")
 
-    cache_dir = state.storage.get_cache_dir(apk_id)
-    files = state.processor.list_files_from_cache(cache_dir)
-    return {"files": files}
+    # The decompiled tree never changes after upload, so walk and serialize it only once
+    body = state.file_tree_cache.get(apk_id)
+    if body is None:
+        cache_dir = state.storage.get_cache_dir(apk_id)
+        files = state.processor.list_files_from_cache(cache_dir)
+        body = FileTreeResponse.model_construct(files=files).model_dump_json().encode()
+        state.file_tree_cache[apk_id] = body
+    return Response(content=body, media_type="application/json")
 
 
-@router.get("/{apk_id}/files/{path:path}")
+@router.get("/{apk_id}/files/{path:path}", response_model=FileContentResponse)
 async def read_apk_file(apk_id: str, path: str):
     """查看 APK 内部脚本文件内容（从缓存读取）。"""
     if apk_id not in state.apk_metadata:
@@ -168,30 +170,32 @@ async def read_apk_file(apk_id: str, path: str):
 
     cache_dir = state.storage.get_cache_dir(apk_id)
     try:
-        content = state.processor.read_file_from_cache(cache_dir, path)
+        content = state.processor.read_file_from_cache(
+            cache_dir, path, meta.get("decompiled_root")
+        )
     except ValueError as e:
         return _error_response(400, "INVALID_RULE", str(e))
     except FileNotFoundError:
         return _error_response(404, "FILE_NOT_FOUND", f"文件不存在: {path}")
 
-    return {"content": content}
+    return FileContentResponse.model_construct(content=content)
 
 
-@router.get("/{apk_id}/tasks")
+@router.get("/{apk_id}/tasks", response_model=TaskListResponse)
 async def list_apk_tasks(apk_id: str):
     """获取 APK 关联的任务列表。"""
     if apk_id not in state.apk_metadata:
         return _error_response(404, "APK_NOT_FOUND", f"APK {apk_id} 不存在")
 
-    task_summaries = [
-        TaskSummary(
+    # Task records are written by this service only, so skip re-validating them
+    task_summaries = []
+    for tid in state.tasks_by_apk.get(apk_id, ()):
+        t = state.tasks[tid]
+        task_summaries.append(TaskSummary.model_construct(
             task_id=tid,
-            status=TaskStatus(t["status"]) if isinstance(t["status"], str) else t["status"],
+            status=TaskStatus(t["status"]),
             created_at=t["created_at"],
             completed_at=t.get("completed_at"),
-        )
-        for tid, t in state.tasks.items()
-        if t.get("apk_id") == apk_id
-    ]
-    return {"tasks": task_summaries}
+        ))
+    return TaskListResponse.model_construct(tasks=task_summaries)
 
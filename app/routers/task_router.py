@@ -2,10 +2,12 @@
 
 from __future__ import annotations
 
+import logging
+import os
+import secrets
 from datetime import datetime, timezone
-from uuid import uuid4
 
-from fastapi import APIRouter, BackgroundTasks
+from fastapi import APIRouter
 from fastapi.responses import FileResponse, JSONResponse
 
 from app import state
@@ -18,8 +20,13 @@ from app.models.schemas import (
 )
 from app.services.rule_engine import RuleEngine
 
+logger = logging.getLogger(__name__)
+
 router = APIRouter(prefix="/api/v1", tags=["tasks"])
 
+# Number of worker coroutines consuming state.task_queue
+TASK_WORKERS = int(os.environ.get("TASK_WORKERS", os.cpu_count() or 1))
+
 
 def _error_response(status_code: int, code: str, message: str, details: dict | None = None) -> JSONResponse:
     """Build a standardized error response."""
@@ -37,7 +44,10 @@ def _error_response(status_code: int, code: str, message: str, details: dict | N
 
 async def _run_task(task_id: str, apk_id: str, rules: list) -> None:
     """Background task: process the APK modification."""
-    task = state.tasks[task_id]
+    task = state.tasks.get(task_id)
+    if task is None:
+        # The APK (and its tasks) was deleted while the job was queued
+        return
     task["status"] = TaskStatus.PROCESSING
 
     cache_dir = state.storage.get_cache_dir(apk_id)
@@ -56,8 +66,20 @@ async def _run_task(task_id: str, apk_id: str, rules: list) -> None:
         task["completed_at"] = datetime.now(tz=timezone.utc)
 
 
+async def task_worker() -> None:
+    """Consume queued tasks one at a time until cancelled."""
+    while True:
+        task_id, apk_id, rules = await state.task_queue.get()
+        try:
+            await _run_task(task_id, apk_id, rules)
+        except Exception:
+            logger.exception("Task worker failed on task %s", task_id)
+        finally:
+            state.task_queue.task_done()
+
+
 @router.post("/tasks")
-async def create_task(request: CreateTaskRequest, background_tasks: BackgroundTasks):
+async def create_task(request: CreateTaskRequest):
     """创建修改任务：验证规则，检查缓存就绪，启动后台处理。"""
     # Check APK exists
     if request.apk_id not in state.apk_metadata:
@@ -80,9 +102,9 @@ async def create_task(request: CreateTaskRequest, background_tasks: BackgroundTa
         )
 
     # Create task
-    task_id = uuid4().hex
+    task_id = secrets.token_hex(16)
     now = datetime.now(tz=timezone.utc)
-    state.tasks[task_id] = {
+    state.add_task(task_id, {
         "apk_id": request.apk_id,
         "status": TaskStatus.PENDING,
         "created_at": now,
@@ -90,10 +112,10 @@ async def create_task(request: CreateTaskRequest, background_tasks: BackgroundTa
         "download_url": None,
         "rule_results": [],
         "error": None,
-    }
+    })
 
-    # Start background processing
-    background_tasks.add_task(_run_task, task_id, request.apk_id, request.rules)
+    # Queue for the worker pool; bounded concurrency instead of one coroutine per request
+    state.task_queue.put_nowait((task_id, request.apk_id, request.rules))
 
     return {"task_id": task_id, "status": "pending"}
 
@@ -104,8 +126,9 @@ async def get_task(task_id: str):
     if task_id not in state.tasks:
         return _error_response(404, "TASK_NOT_FOUND", f"任务 {task_id} 不存在")
 
+    # Task records are written by this service only, so skip re-validating them
     task = state.tasks[task_id]
-    return TaskResponse(
+    return TaskResponse.model_construct(
         task_id=task_id,
         apk_id=task["apk_id"],
         status=task["status"],
@@ -127,8 +150,11 @@ async def download_task(task_id: str):
     if task["status"] != TaskStatus.COMPLETED:
         return _error_response(404, "DOWNLOAD_NOT_FOUND", "下载文件不存在或任务未完成")
 
+    # Stat once and hand the result to FileResponse so it doesn't stat again
     output_path = state.storage.get_output_path(task_id)
-    if not output_path.exists():
+    try:
+        stat_result = output_path.stat()
+    except FileNotFoundError:
         return _error_response(404, "DOWNLOAD_NOT_FOUND", "下载文件不存在")
 
     # Use original APK filename for download
@@ -140,4 +166,5 @@ async def download_task(task_id: str):
         path=str(output_path),
         media_type="application/vnd.android.package-archive",
         headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+        stat_result=stat_result,
     )
@@ -1,16 +1,238 @@
 """APK Processor - APK 反编译、缓存复制与重新打包"""
 
 import asyncio
+import contextlib
+import functools
+import itertools
+import logging
+import mmap
+import os
+import secrets
+import shlex
 import shutil
-from pathlib import Path
+import stat
+import tempfile
+from pathlib import Path, PurePosixPath
+
+try:
+    import fcntl
+except ImportError:  # 非 POSIX 平台
+    fcntl = None
+
+from pydantic import BaseModel
+from pydantic import ValidationError as PydanticValidationError
 
 from app.models.schemas import FileNode, ImageRule, ReplacementRule, RuleResult, ScriptRule
 from app.services.rule_engine import RuleEngine
+from app.services.storage_service import _fast_rmtree
+
+logger = logging.getLogger(__name__)
+
+
+# 持久化文件树索引的文件名，位于 data/cache/{apk_id}/ 下
+_FILE_TREE_INDEX = "files.json"
+
+
+class _FileTreeIndex(BaseModel):
+    """files.json 的内容：decompiled 目录的 mtime 与对应的文件树"""
+
+    mtime_ns: int
+    files: list[FileNode]
+
+
+# Linux FICLONE ioctl: 在 Btrfs/XFS 等文件系统上创建共享数据块的 reflink 副本
+_FICLONE = 0x40049409
+
+
+def _reflink(src: str, dst: str) -> bool:
+    """尝试以 reflink 克隆文件（仅元数据操作），不支持时返回 False。"""
+    if fcntl is None:
+        return False
+    try:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+    except OSError:
+        # 删除已创建的空目标文件，便于调用方改用 link 等其它方式
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(dst)
+        return False
+    shutil.copystat(src, dst)
+    return True
+
+
+def _copy_file(src: str, dst: str) -> None:
+    """复制单个文件：优先 reflink，否则 shutil.copy2（Linux 上内部使用 sendfile 零拷贝）。"""
+    if not _reflink(src, dst):
+        shutil.copy2(src, dst)
+
+
+def _link_or_copy(src: str, dst: str) -> None:
+    """为缓存文件创建 hardlink；跨文件系统等无法 link 时回退为复制。"""
+    try:
+        os.link(src, dst)
+    except OSError:
+        _copy_file(src, dst)
+
+
+# _discard_dir 提交到线程池的后台删除；持有引用以便记录失败，并在关闭时等待完成
+_pending_discards: set[asyncio.Future] = set()
+
+
+def _discard_done(future: asyncio.Future) -> None:
+    _pending_discards.discard(future)
+    if not future.cancelled() and future.exception() is not None:
+        logger.error("后台删除工作目录失败", exc_info=future.exception())
+
+
+def _discard_dir(path: Path) -> None:
+    """丢弃目录：先重命名移出原路径（一次系统调用），再在线程池中后台删除。
+
+    工作目录可能包含成千上万个文件，失败路径不必等待删除完成；无法重命名时
+    同样在后台删除原目录，事件循环线程上不做任何递归删除。
+    进程在后台删除完成前退出时，残留目录由启动时的 StorageService.purge_trash 清理。
+    必须在事件循环中调用。
+    """
+    trash = path.with_name(f"{path.name}.trash.{secrets.token_hex(4)}")
+    try:
+        os.rename(path, trash)
+    except FileNotFoundError:
+        return
+    except OSError:
+        trash = path
+    future = asyncio.get_running_loop().run_in_executor(None, _fast_rmtree, trash)
+    _pending_discards.add(future)
+    future.add_done_callback(_discard_done)
+
+
+async def wait_for_discards() -> None:
+    """等待所有进行中的后台目录删除完成（应用关闭时调用）"""
+    if _pending_discards:
+        await asyncio.gather(*_pending_discards, return_exceptions=True)
+
+
+# apktool b 会原地改写源目录中的这些文件（如为 AndroidManifest.xml 留下 .orig 备份后
+# 直接修改），它们不经过 RuleEngine 的临时文件 + os.replace，打包前必须与缓存断开链接
+_APKTOOL_BUILD_REWRITES = ("AndroidManifest.xml", "apktool.yml")
+
+
+def _break_links(source_dir: Path, names: tuple[str, ...]) -> None:
+    """把 source_dir 下与其它路径共享 inode 的文件替换为独立副本。
+
+    先复制到同目录临时文件再 os.replace，缓存中的原 inode 保持不变；
+    不存在或未共享（st_nlink == 1，如 reflink/copy 克隆）的文件跳过。
+    """
+    for name in names:
+        path = os.path.join(source_dir, name)
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            continue
+        if not stat.S_ISREG(st.st_mode) or st.st_nlink == 1:
+            continue
+        # mkstemp 取得不会与反编译目录中已有文件重名的临时路径，再整体覆盖写入
+        fd, tmp = tempfile.mkstemp(dir=source_dir, prefix=f".{name}.", suffix=".tmp")
+        os.close(fd)
+        try:
+            _copy_file(path, tmp)
+            os.replace(tmp, path)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(tmp)
+            raise
+
+
+class _AutoClone:
+    """按 reflink → hardlink → 复制 的顺序克隆文件（一次 copytree 使用一个实例）。
+
+    reflink 第一次失败后（如 ext4 不支持 FICLONE），本次复制的其余文件
+    直接走 hardlink，不再重复尝试。
+    """
+
+    def __init__(self) -> None:
+        self._try_reflink = True
+
+    def __call__(self, src: str, dst: str) -> None:
+        if self._try_reflink:
+            if _reflink(src, dst):
+                return
+            self._try_reflink = False
+        _link_or_copy(src, dst)
+
+
+# 同时运行的 apktool 进程上限：每个 apktool 都是独立的 JVM（数百 MB 常驻内存），
+# 不加限制时并发上传/任务会挤爆内存。可通过环境变量 APKTOOL_MAX_CONCURRENCY 覆盖。
+APKTOOL_MAX_CONCURRENCY = int(
+    os.environ.get("APKTOOL_MAX_CONCURRENCY", max(1, (os.cpu_count() or 2) // 2))
+)
+
+# 调用 apktool 的命令前缀。默认直接执行 apktool 脚本（每次冷启动一个 JVM）；
+# 部署时可通过环境变量 APKTOOL_CMD 指向常驻 JVM 的客户端（如 nailgun 的
+# "ng brut.apktool.Main"）以省去 JVM 启动开销。
+APKTOOL_CMD = shlex.split(os.environ.get("APKTOOL_CMD", "apktool"))
+
+# 浏览文件时超过该大小的文件经 mmap 解码: 1 MiB
+_MMAP_READ_THRESHOLD = 1024 * 1024
+
+# 失败时错误信息中保留的 apktool stderr 末尾字节数
+_STDERR_TAIL_BYTES = 64 * 1024
+
+
+# 工作副本中文件的克隆方式：
+#   auto     - 默认；支持写时复制的文件系统（Btrfs/XFS）上用 reflink，否则同 hardlink
+#   hardlink - 与缓存共享 inode；规则引擎只通过临时文件 + os.replace 写入，
+#              从不原地修改，因此缓存内容不会被工作副本改动
+#   reflink  - 写时复制克隆，不支持时退化为普通复制
+#   copy     - 始终复制文件内容
+# 可通过环境变量 WORKDIR_CLONE_STRATEGY 覆盖。
+_CLONE_FUNCTIONS = {
+    "hardlink": _link_or_copy,
+    "reflink": _copy_file,
+    "copy": shutil.copy2,
+}
+_CLONE_STRATEGIES = ("auto", *_CLONE_FUNCTIONS)
+WORKDIR_CLONE_STRATEGY = os.environ.get("WORKDIR_CLONE_STRATEGY", "auto")
 
 
 class APKProcessor:
     """APK 处理器：负责反编译、缓存管理和重新打包"""
 
+    def __init__(
+        self,
+        max_concurrency: int = APKTOOL_MAX_CONCURRENCY,
+        apktool_cmd: list[str] = APKTOOL_CMD,
+        clone_strategy: str = WORKDIR_CLONE_STRATEGY,
+    ) -> None:
+        if clone_strategy not in _CLONE_STRATEGIES:
+            raise ValueError(
+                f"未知的 clone_strategy: {clone_strategy!r}，"
+                f"可选值: {', '.join(_CLONE_STRATEGIES)}"
+            )
+        self._apktool_semaphore = asyncio.Semaphore(max_concurrency)
+        self._apktool_cmd = list(apktool_cmd)
+        self._clone_strategy = clone_strategy
+
+    async def _run_apktool(self, *args: str) -> tuple[int, bytes]:
+        """运行一次 apktool 命令，受并发上限约束。
+
+        stdout 只是进度日志，直接丢弃；stderr 边读边丢弃旧内容，只保留末尾
+        _STDERR_TAIL_BYTES 字节用于错误信息，内存占用与输出量无关。
+
+        Returns:
+            (退出码, stderr 末尾内容)
+        """
+        async with self._apktool_semaphore:
+            process = await asyncio.create_subprocess_exec(
+                *self._apktool_cmd, *args,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            tail = bytearray()
+            while chunk := await process.stderr.read(_STDERR_TAIL_BYTES):
+                tail += chunk
+                del tail[:-_STDERR_TAIL_BYTES]
+            await process.wait()
+        return process.returncode, bytes(tail)
+
     async def decompile_to_cache(self, apk_path: Path, cache_dir: Path) -> None:
         """使用 apktool 反编译 APK 到缓存目录（上传时调用）。
 
@@ -26,23 +248,23 @@ class APKProcessor:
         output_dir = cache_dir / "decompiled"
         cache_dir.mkdir(parents=True, exist_ok=True)
 
-        process = await asyncio.create_subprocess_exec(
-            "apktool", "d", str(apk_path), "-o", str(output_dir), "-f",
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
+        returncode, stderr = await self._run_apktool(
+            "d", str(apk_path), "-o", str(output_dir), "-f"
         )
-        stdout, stderr = await process.communicate()
 
-        if process.returncode != 0:
+        if returncode != 0:
             error_msg = stderr.decode("utf-8", errors="replace").strip()
             raise RuntimeError(
-                f"apktool 反编译失败 (exit code {process.returncode}): {error_msg}"
+                f"apktool 反编译失败 (exit code {returncode}): {error_msg}"
             )
 
     async def copy_cache_to_workdir(self, cache_dir: Path, work_dir: Path) -> None:
-        """从缓存目录复制一份工作副本（创建任务时调用）。
+        """从缓存目录克隆一份工作副本（创建任务时调用）。
 
-        使用 shutil.copytree 在 executor 中运行，避免阻塞事件循环。
+        目录结构逐级重建，文件以 hardlink 方式共享缓存中的 inode，只需元数据
+        操作而无需复制文件内容。工作副本中的文件必须通过写临时文件再
+        os.replace 的方式修改（RuleEngine 即如此），不能原地写入，否则会
+        修改缓存；apktool b 原地改写的文件由 recompile 在打包前断开链接。
 
         Args:
             cache_dir: 缓存目录 (data/cache/{apk_id}/)
@@ -55,9 +277,15 @@ class APKProcessor:
         try:
             await loop.run_in_executor(
                 None,
-                shutil.copytree,
-                str(cache_dir),
-                str(work_dir),
+                functools.partial(
+                    shutil.copytree,
+                    str(cache_dir),
+                    str(work_dir),
+                    copy_function=(
+                        _AutoClone() if self._clone_strategy == "auto"
+                        else _CLONE_FUNCTIONS[self._clone_strategy]
+                    ),
+                ),
             )
         except Exception as e:
             raise RuntimeError(f"复制缓存到工作目录失败: {e}") from e
@@ -76,17 +304,20 @@ class APKProcessor:
         """
         output_apk.parent.mkdir(parents=True, exist_ok=True)
 
-        process = await asyncio.create_subprocess_exec(
-            "apktool", "b", str(source_dir), "-o", str(output_apk),
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
+        # 工作副本可能以 hardlink 共享缓存文件，apktool 原地改写的文件要先断开链接
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            None, _break_links, source_dir, _APKTOOL_BUILD_REWRITES
+        )
+
+        returncode, stderr = await self._run_apktool(
+            "b", str(source_dir), "-o", str(output_apk)
         )
-        stdout, stderr = await process.communicate()
 
-        if process.returncode != 0:
+        if returncode != 0:
             error_msg = stderr.decode("utf-8", errors="replace").strip()
             raise RuntimeError(
-                f"apktool 重新打包失败 (exit code {process.returncode}): {error_msg}"
+                f"apktool 重新打包失败 (exit code {returncode}): {error_msg}"
             )
 
     def list_files_from_cache(self, cache_dir: Path) -> list[FileNode]:
@@ -99,43 +330,81 @@ class APKProcessor:
             FileNode 树的根节点列表（decompiled 目录下的顶层条目）
         """
         decompiled_dir = cache_dir / "decompiled"
-        if not decompiled_dir.is_dir():
+        try:
+            st = os.stat(decompiled_dir)
+        except OSError:
             return []
+        if not stat.S_ISDIR(st.st_mode):
+            return []
+        mtime_ns = st.st_mtime_ns
 
-        def build_tree(directory: Path, base: Path) -> list[FileNode]:
-            nodes: list[FileNode] = []
+        # 反编译缓存在两次 apktool 运行之间不会变化，文件树持久化到 files.json，
+        # 以 decompiled 目录的 mtime 作为失效依据
+        index_path = cache_dir / _FILE_TREE_INDEX
+        try:
+            index = _FileTreeIndex.model_validate_json(index_path.read_bytes())
+            if index.mtime_ns == mtime_ns:
+                return index.files
+        except (OSError, PydanticValidationError):
+            pass
+
+        def build_tree(directory: str, rel_base: str) -> list[FileNode]:
+            # os.scandir 返回的 DirEntry 缓存了 readdir 得到的类型信息，
+            # 无需对每个条目再单独 stat 判断是否为目录
             try:
-                entries = sorted(directory.iterdir(), key=lambda e: (not e.is_dir(), e.name.lower()))
+                with os.scandir(directory) as it:
+                    entries = sorted(
+                        it, key=lambda e: (not e.is_dir(follow_symlinks=False), e.name.lower())
+                    )
             except OSError:
-                return nodes
-
-            for entry in entries:
-                rel_path = str(entry.relative_to(base))
-                if entry.is_dir():
-                    children = build_tree(entry, base)
-                    nodes.append(FileNode(
-                        name=entry.name,
-                        path=rel_path,
-                        is_directory=True,
-                        children=children,
-                    ))
-                else:
-                    nodes.append(FileNode(
-                        name=entry.name,
-                        path=rel_path,
-                        is_directory=False,
-                        size=entry.stat().st_size,
-                    ))
-            return nodes
+                return []
+            return [build_node(entry, rel_base) for entry in entries]
+
+        def build_node(entry: os.DirEntry, rel_base: str) -> FileNode:
+            # 字段均来自文件系统，类型已确定，用 model_construct 跳过逐节点的验证
+            # 相对路径统一使用 '/' 分隔，直接拼接字符串
+            rel_path = f"{rel_base}/{entry.name}" if rel_base else entry.name
+            if entry.is_dir(follow_symlinks=False):
+                return FileNode.model_construct(
+                    name=entry.name,
+                    path=rel_path,
+                    is_directory=True,
+                    children=build_tree(entry.path, rel_path),
+                    size=None,
+                )
+            return FileNode.model_construct(
+                name=entry.name,
+                path=rel_path,
+                is_directory=False,
+                children=[],
+                size=entry.stat(follow_symlinks=False).st_size,
+            )
 
-        return build_tree(decompiled_dir, decompiled_dir)
+        files = build_tree(str(decompiled_dir), "")
 
-    def read_file_from_cache(self, cache_dir: Path, internal_path: str) -> str:
+        tmp_path = index_path.with_name(index_path.name + ".tmp")
+        try:
+            tmp_path.write_text(
+                _FileTreeIndex.model_construct(mtime_ns=mtime_ns, files=files).model_dump_json(),
+                encoding="utf-8",
+            )
+            os.replace(tmp_path, index_path)
+        except OSError:
+            # 索引只是加速手段，写入失败不影响本次结果
+            tmp_path.unlink(missing_ok=True)
+
+        return files
+
+    def read_file_from_cache(
+        self, cache_dir: Path, internal_path: str, decompiled_root: str | None = None
+    ) -> str:
         """从缓存目录读取指定文件的文本内容。
 
         Args:
             cache_dir: 缓存根目录 (data/cache/{apk_id}/)
             internal_path: APK 内部相对路径 (e.g. "res/values/strings.xml")
+            decompiled_root: 预先解析好的 decompiled 目录真实路径（上传时记录），
+                省略时现场解析
 
         Returns:
             文件的 UTF-8 文本内容
@@ -144,22 +413,54 @@ class APKProcessor:
             ValueError: 路径包含遍历攻击或为绝对路径
             FileNotFoundError: 文件不存在
         """
-        if ".." in internal_path:
-            raise ValueError("路径不允许包含 '..'")
-        if internal_path.startswith("/"):
-            raise ValueError("路径不允许以 '/' 开头")
+        # 按路径分段检查：只拒绝 '..' 分段，文件名中出现的 '..' (如 a..b.txt) 不受影响
+        rel = PurePosixPath(internal_path)
+        if rel.is_absolute() or ".." in rel.parts:
+            raise ValueError("路径不允许以 '/' 开头或包含 '..'")
 
-        target = cache_dir / "decompiled" / internal_path
+        if decompiled_root is None:
+            decompiled_root = os.path.realpath(cache_dir / "decompiled")
         # Resolve and verify the target is still within the decompiled directory
-        decompiled_dir = (cache_dir / "decompiled").resolve()
-        resolved_target = target.resolve()
-        if not str(resolved_target).startswith(str(decompiled_dir)):
+        resolved_target = os.path.realpath(os.path.join(decompiled_root, internal_path))
+        if resolved_target == decompiled_root:
+            # "" 或 "." 指向 decompiled 目录本身，不是文件
+            raise FileNotFoundError(f"文件不存在: {internal_path}")
+        if not resolved_target.startswith(decompiled_root + os.sep):
             raise ValueError("路径遍历攻击被阻止")
 
-        if not resolved_target.is_file():
+        try:
+            fd = os.open(resolved_target, os.O_RDONLY)
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
             raise FileNotFoundError(f"文件不存在: {internal_path}")
-
-        return resolved_target.read_text(encoding="utf-8")
+        try:
+            st = os.fstat(fd)
+            if not stat.S_ISREG(st.st_mode):
+                raise FileNotFoundError(f"文件不存在: {internal_path}")
+            # 一次 read 读入整个文件再解码；大文件经 mmap 解码，避免同时持有读缓冲区副本
+            if st.st_size > _MMAP_READ_THRESHOLD:
+                with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mm:
+                    return str(mm, "utf-8")
+            return os.read(fd, st.st_size).decode("utf-8")
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _apply_rule(
+        rule_engine: RuleEngine, base_dir: Path, index: int, rule: ReplacementRule
+    ) -> RuleResult:
+        """在工作副本上执行单条规则，并设置正确的 rule_index"""
+        if isinstance(rule, ScriptRule):
+            result = rule_engine.apply_script_rule(base_dir, rule)
+        elif isinstance(rule, ImageRule):
+            result = rule_engine.apply_image_rule(base_dir, rule)
+        else:
+            result = RuleResult(
+                rule_index=index,
+                success=False,
+                message=f"未知的规则类型: {type(rule).__name__}",
+            )
+        result.rule_index = index
+        return result
 
     async def process_task(
         self,
@@ -187,35 +488,54 @@ class APKProcessor:
             await self.copy_cache_to_workdir(cache_dir, work_dir)
         except Exception:
             # 复制失败时清理工作目录
-            shutil.rmtree(work_dir, ignore_errors=True)
+            _discard_dir(work_dir)
             raise
 
-        # Step 2: 在工作副本上依次应用规则
+        # Step 2: 在工作副本上应用规则。规则按目标文件分组：同一文件的规则保持
+        # 原有顺序依次执行，不同文件的分组在线程池中并行执行
         rule_engine = RuleEngine()
         decompiled_dir = work_dir / "decompiled"
-        rule_results: list[RuleResult] = []
 
+        groups: dict[str, list[tuple[int, ReplacementRule]]] = {}
         for index, rule in enumerate(rules):
-            if isinstance(rule, ScriptRule):
-                result = rule_engine.apply_script_rule(decompiled_dir, rule)
-            elif isinstance(rule, ImageRule):
-                result = rule_engine.apply_image_rule(decompiled_dir, rule)
-            else:
-                result = RuleResult(
-                    rule_index=index,
-                    success=False,
-                    message=f"未知的规则类型: {type(rule).__name__}",
-                )
-            # 设置正确的 rule_index
-            result.rule_index = index
-            rule_results.append(result)
+            groups.setdefault(os.path.normpath(rule.target_path), []).append((index, rule))
+
+        def apply_group(group: list[tuple[int, ReplacementRule]]) -> list[RuleResult]:
+            results: list[RuleResult] = []
+            # 连续的多条脚本规则合并执行，文件只读写一次
+            for is_script, run in itertools.groupby(
+                group, key=lambda item: isinstance(item[1], ScriptRule)
+            ):
+                run = list(run)
+                if is_script and len(run) > 1:
+                    batch = rule_engine.apply_script_rules(
+                        decompiled_dir, [rule for _, rule in run]
+                    )
+                    for (index, _), result in zip(run, batch):
+                        result.rule_index = index
+                        results.append(result)
+                else:
+                    results.extend(
+                        self._apply_rule(rule_engine, decompiled_dir, index, rule)
+                        for index, rule in run
+                    )
+            return results
+
+        loop = asyncio.get_running_loop()
+        group_results = await asyncio.gather(*(
+            loop.run_in_executor(None, apply_group, group) for group in groups.values()
+        ))
+        rule_results = sorted(
+            (result for results in group_results for result in results),
+            key=lambda r: r.rule_index,
+        )
 
         # Step 3: 重新打包
         try:
             await self.recompile(decompiled_dir, output_path)
         except Exception:
             # 重新打包失败时清理工作目录
-            shutil.rmtree(work_dir, ignore_errors=True)
+            _discard_dir(work_dir)
             raise
 
         return rule_results
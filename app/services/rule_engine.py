@@ -1,7 +1,14 @@
 """Rule Engine - 规则验证与执行"""
 
-import base64
+import binascii
+import contextlib
+import functools
+import mmap
+import os
 import re
+import shutil
+import string
+import tempfile
 from pathlib import Path, PurePosixPath
 
 from app.models.schemas import (
@@ -14,6 +21,165 @@ from app.models.schemas import (
 )
 
 
+@functools.lru_cache(maxsize=1024)
+def _compiled(pattern: str, flags: int = 0) -> re.Pattern:
+    """编译正则表达式并缓存，验证与执行阶段以及不同任务间共用同一对象。
+
+    缓存键只包含 (pattern, flags) 两个基本类型值。
+    """
+    return re.compile(pattern, flags)
+
+
+@functools.lru_cache(maxsize=1024)
+def _pattern_error(pattern: str) -> str | None:
+    """校验正则表达式，返回错误信息，有效时返回 None。
+
+    lru_cache 不缓存异常，无效的模式在 _compiled 中每次都会重新编译；
+    这里把 re.error 的信息作为结果缓存下来，批量验证中重复的无效模式只编译一次。
+    """
+    try:
+        _compiled(pattern)
+    except re.error as e:
+        return str(e)
+    return None
+
+
+# 标准 Base64 字符集（含填充符），用于 bytes.translate 的删除表
+_B64_ALPHABET = (string.ascii_letters + string.digits + "+/=").encode("ascii")
+
+# 图片数据分块校验/解码时每块的 Base64 字符数（必须是 4 的倍数，1 MiB -> 768 KiB）
+_B64_CHUNK_CHARS = 1024 * 1024
+
+
+def _is_canonical_base64(data: str) -> bool:
+    """判断是否为规范形式的 Base64：长度为 4 的倍数，'=' 只出现在最后一组末尾。
+
+    分块 encode 后用 translate 删除所有合法字符，剩余非空即含非法字符；
+    单遍 C 循环，且只分配一块的临时字节串，不会为验证分配与图片等大的内存。
+    规范形式的数据可以按 4 的倍数任意分块解码。
+    """
+    if len(data) % 4 or not data.isascii():
+        return False
+    for start in range(0, len(data), _B64_CHUNK_CHARS):
+        if data[start:start + _B64_CHUNK_CHARS].encode("ascii").translate(None, _B64_ALPHABET):
+            return False
+    # '=' 只能出现在最后两位，且出现时必须延续到结尾
+    pad = data.find("=")
+    return pad == -1 or (pad >= len(data) - 2 and data[-1] == "=")
+
+
+def _is_valid_base64(data: str) -> bool:
+    """校验 Base64 格式，判定与 b64decode(validate=True)（即 a2b_base64 严格模式）一致。
+
+    绝大多数数据是规范形式，走 _is_canonical_base64 快速路径而不解码；
+    其余情况（如完整分组后多余的 '='，严格模式同样接受）交给 binascii 判定。
+    """
+    if _is_canonical_base64(data):
+        return True
+    try:
+        binascii.a2b_base64(data, strict_mode=True)
+    except (binascii.Error, ValueError):
+        return False
+    return True
+
+
+@contextlib.contextmanager
+def _atomic_open(path: str):
+    """打开同目录临时文件用于写入，成功后 os.replace 到目标路径。
+
+    工作副本中的文件可能是缓存文件的 hardlink，替换目录项而非原地写入，
+    可保证缓存内容不被修改；写入中途失败也不会留下半截的目标文件。
+    临时文件由 mkstemp 创建（不会与反编译目录中已有的文件重名），
+    替换前复制原文件的权限位。
+    """
+    directory, name = os.path.split(path)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=f".{name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            yield f
+        shutil.copymode(path, tmp)
+        os.replace(tmp, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(tmp)
+        raise
+
+
+def _write_atomic(path: str, data: bytes) -> None:
+    """原子地写入完整内容，见 _atomic_open"""
+    with _atomic_open(path) as f:
+        f.write(data)
+
+
+def _read_if_contains(path: str, needle: bytes) -> bytes | None:
+    """文件包含 needle 时返回完整内容，否则返回 None。
+
+    先在只读 mmap 上查找，不包含时无需把整个文件读入内存。
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None if needle else b""
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if mm.find(needle) == -1:
+                return None
+            return mm[:]
+
+
+def _replace_in_place(path: str, old: bytes, new: bytes) -> int | None:
+    """等长字面量替换：通过可写 mmap 原地覆盖，返回替换次数。
+
+    仅当文件只有一个链接时才原地修改；hardlink 到缓存的文件（st_nlink > 1）
+    必须走临时文件 + os.replace，此时返回 None 由调用方处理。
+    """
+    if not old or len(old) != len(new):
+        return None
+    with open(path, "r+b") as f:
+        st = os.fstat(f.fileno())
+        if st.st_nlink != 1 or st.st_size == 0:
+            return None
+        count = 0
+        with mmap.mmap(f.fileno(), 0) as mm:
+            pos = mm.find(old)
+            while pos != -1:
+                mm[pos:pos + len(old)] = new
+                count += 1
+                pos = mm.find(old, pos + len(old))
+        return count
+
+
+def _target_missing(rule: ReplacementRule) -> RuleResult:
+    """目标文件不存在时的规则结果"""
+    return RuleResult(
+        rule_index=0,
+        success=False,
+        message=f"目标文件不存在: {rule.target_path}",
+    )
+
+
+def _script_applied(rule: ScriptRule, count: int) -> RuleResult:
+    """脚本规则执行完成（count 为 0 表示没有匹配、文件未修改）时的规则结果"""
+    if count == 0:
+        return RuleResult(
+            rule_index=0,
+            success=True,
+            message=f"未找到匹配，文件未修改: {rule.target_path}",
+        )
+    return RuleResult(
+        rule_index=0,
+        success=True,
+        message=f"脚本替换成功: {rule.target_path}, 替换了 {count} 处匹配",
+    )
+
+
+def _script_failed(rule: ScriptRule, error: Exception) -> RuleResult:
+    """脚本规则执行出错时的规则结果"""
+    return RuleResult(
+        rule_index=0,
+        success=False,
+        message=f"脚本替换失败: {rule.target_path}, 错误: {error}",
+    )
+
+
 class RuleEngine:
     """规则引擎：负责验证和执行替换规则"""
 
@@ -37,7 +203,7 @@ class RuleEngine:
         """验证 target_path 字段"""
         errors: list[ValidationError] = []
 
-        if not target_path or not target_path.strip():
+        if not target_path or target_path.isspace():
             errors.append(
                 ValidationError(
                     rule_index=rule_index,
@@ -73,7 +239,7 @@ class RuleEngine:
         """验证 ScriptRule 特有字段"""
         errors: list[ValidationError] = []
 
-        if not rule.pattern or not rule.pattern.strip():
+        if not rule.pattern or rule.pattern.isspace():
             errors.append(
                 ValidationError(
                     rule_index=rule_index,
@@ -84,14 +250,13 @@ class RuleEngine:
             return errors
 
         if rule.use_regex:
-            try:
-                re.compile(rule.pattern)
-            except re.error as e:
+            error = _pattern_error(rule.pattern)
+            if error is not None:
                 errors.append(
                     ValidationError(
                         rule_index=rule_index,
                         field="pattern",
-                        message=f"无效的正则表达式: {e}",
+                        message=f"无效的正则表达式: {error}",
                     )
                 )
 
@@ -103,7 +268,8 @@ class RuleEngine:
         """验证 ImageRule 特有字段"""
         errors: list[ValidationError] = []
 
-        if not rule.image_data or not rule.image_data.strip():
+        # isspace() 与 strip() 判定相同，但不会复制可能很大的 image_data
+        if not rule.image_data or rule.image_data.isspace():
             errors.append(
                 ValidationError(
                     rule_index=rule_index,
@@ -113,9 +279,7 @@ class RuleEngine:
             )
             return errors
 
-        try:
-            base64.b64decode(rule.image_data, validate=True)
-        except Exception:
+        if not _is_valid_base64(rule.image_data):
             errors.append(
                 ValidationError(
                     rule_index=rule_index,
@@ -128,51 +292,102 @@ class RuleEngine:
 
     def apply_script_rule(self, base_dir: Path, rule: ScriptRule) -> RuleResult:
         """在工作副本目录中执行脚本替换规则"""
-        target_file = base_dir / rule.target_path
+        # 每条规则都会走到这里，用 os.path 拼接字符串，避免构造 Path 对象
+        target_file = os.path.join(base_dir, rule.target_path)
 
-        if not target_file.exists():
-            return RuleResult(
-                rule_index=0,
-                success=False,
-                message=f"目标文件不存在: {rule.target_path}",
-            )
+        if not os.path.exists(target_file):
+            return _target_missing(rule)
 
         try:
-            content = target_file.read_text(encoding="utf-8")
-
             if rule.use_regex:
-                new_content = re.sub(rule.pattern, rule.replacement, content)
+                # 以字节读取再解码，与 apply_script_rules 一致，不做换行符转换（保留 CRLF）
+                with open(target_file, "rb") as f:
+                    content = f.read().decode("utf-8")
+                new_content, count = _compiled(rule.pattern).subn(rule.replacement, content)
+                new_data = new_content.encode("utf-8") if count else None
             else:
-                new_content = content.replace(rule.pattern, rule.replacement)
+                # 字面量替换直接在字节上进行：UTF-8 是自同步编码，编码后的模式
+                # 只会匹配完整字符，省去整文件的解码与重新编码
+                pattern = rule.pattern.encode("utf-8")
+                replacement = rule.replacement.encode("utf-8")
+                count = None
+                if len(pattern) == len(replacement):
+                    count = _replace_in_place(target_file, pattern, replacement)
+                if count is not None:
+                    new_data = None
+                else:
+                    data = _read_if_contains(target_file, pattern)
+                    count = data.count(pattern) if data is not None else 0
+                    new_data = data.replace(pattern, replacement) if count else None
+
+            # 没有匹配时不重写文件
+            if new_data is not None:
+                _write_atomic(target_file, new_data)
+            return _script_applied(rule, count)
+        except Exception as e:
+            return _script_failed(rule, e)
 
-            target_file.write_text(new_content, encoding="utf-8")
+    def apply_script_rules(self, base_dir: Path, rules: list[ScriptRule]) -> list[RuleResult]:
+        """对同一目标文件依次执行多条脚本规则，整个文件只读写一次。
 
-            return RuleResult(
-                rule_index=0,
-                success=True,
-                message=f"脚本替换成功: {rule.target_path}",
-            )
+        结果与逐条调用 apply_script_rule 相同：每条规则看到前一条规则的结果，
+        单条规则出错不影响其它规则。文件不是有效 UTF-8 时退回逐条执行。
+        """
+        target_file = os.path.join(base_dir, rules[0].target_path)
+
+        if not os.path.exists(target_file):
+            return [_target_missing(rule) for rule in rules]
+
+        try:
+            with open(target_file, "rb") as f:
+                content = f.read().decode("utf-8")
+        except UnicodeDecodeError:
+            return [self.apply_script_rule(base_dir, rule) for rule in rules]
         except Exception as e:
-            return RuleResult(
-                rule_index=0,
-                success=False,
-                message=f"脚本替换失败: {rule.target_path}, 错误: {e}",
-            )
+            return [_script_failed(rule, e) for rule in rules]
+
+        results: list[RuleResult] = []
+        changed: list[int] = []
+        for rule in rules:
+            try:
+                if rule.use_regex:
+                    new_content, count = _compiled(rule.pattern).subn(rule.replacement, content)
+                else:
+                    count = content.count(rule.pattern)
+                    new_content = content.replace(rule.pattern, rule.replacement) if count else content
+            except Exception as e:
+                results.append(_script_failed(rule, e))
+                continue
+            if count:
+                content = new_content
+                changed.append(len(results))
+            results.append(_script_applied(rule, count))
+
+        if changed:
+            try:
+                _write_atomic(target_file, content.encode("utf-8"))
+            except Exception as e:
+                for i in changed:
+                    results[i] = _script_failed(rules[i], e)
+        return results
 
     def apply_image_rule(self, base_dir: Path, rule: ImageRule) -> RuleResult:
         """在工作副本目录中执行图片替换规则"""
-        target_file = base_dir / rule.target_path
+        target_file = os.path.join(base_dir, rule.target_path)
 
-        if not target_file.exists():
-            return RuleResult(
-                rule_index=0,
-                success=False,
-                message=f"目标文件不存在: {rule.target_path}",
-            )
+        if not os.path.exists(target_file):
+            return _target_missing(rule)
 
         try:
-            image_bytes = base64.b64decode(rule.image_data)
-            target_file.write_bytes(image_bytes)
+            # 分块解码写入，避免同时持有完整的 Base64 字符串和解码后的字节；
+            # 直接调用 binascii 的严格模式，省去 base64.b64decode 的 Python 层包装，
+            # 非法字符会报错而不是被静默丢弃
+            # 非规范形式（如末尾多余的 '='）分块后可能切出只有填充的一块，整体解码
+            data = rule.image_data
+            step = _B64_CHUNK_CHARS if _is_canonical_base64(data) else max(len(data), 1)
+            with _atomic_open(target_file) as f:
+                for start in range(0, len(data), step):
+                    f.write(binascii.a2b_base64(data[start:start + step], strict_mode=True))
 
             return RuleResult(
                 rule_index=0,
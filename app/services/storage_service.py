@@ -1,8 +1,9 @@
 """Storage Service - 文件存储与管理"""
 
+import asyncio
 import os
-import shutil
-import uuid
+import secrets
+import struct
 import zipfile
 from datetime import datetime, timezone
 from pathlib import Path
@@ -10,12 +11,103 @@ from pathlib import Path
 from fastapi import UploadFile
 
 
+class FileTooLargeError(Exception):
+    """上传文件超过允许的最大大小"""
+
+
+_MANIFEST_NAME = b"AndroidManifest.xml"
+
+# ZIP 结构常量：中央目录文件头签名与定长部分大小，EOCD 签名与定长部分大小
+_CD_SIGNATURE = b"PK\x01\x02"
+_CD_HEADER_SIZE = 46
+_EOCD_SIGNATURE = b"PK\x05\x06"
+_EOCD_SIZE = 22
+# EOCD 之后最多跟 65535 字节的注释
+_EOCD_SEARCH_SIZE = _EOCD_SIZE + 0xFFFF
+
+
+def _read_central_directory(f) -> bytes | None:
+    """读取 ZIP 中央目录的原始字节。
+
+    Returns:
+        中央目录字节；zip64 或中央目录位置与 EOCD 记录不符时返回 None，
+        由调用方回退到 zipfile 解析
+
+    Raises:
+        ValueError: 找不到 EOCD 记录，不是有效的 ZIP
+    """
+    file_size = f.seek(0, os.SEEK_END)
+    tail_size = min(file_size, _EOCD_SEARCH_SIZE)
+    f.seek(file_size - tail_size)
+    tail = f.read(tail_size)
+
+    eocd = tail.rfind(_EOCD_SIGNATURE)
+    if eocd == -1 or len(tail) - eocd < _EOCD_SIZE:
+        raise ValueError("文件不是有效的 ZIP 格式")
+
+    entries, cd_size, cd_offset = struct.unpack_from("<2xHLL", tail, eocd + 8)
+    if entries == 0xFFFF or cd_size == 0xFFFFFFFF or cd_offset == 0xFFFFFFFF:
+        return None
+    if cd_offset + cd_size > file_size:
+        return None
+
+    f.seek(cd_offset)
+    cd = f.read(cd_size)
+    if cd_size and cd[:4] != _CD_SIGNATURE:
+        return None
+    return cd
+
+
+# APKProcessor 丢弃工作目录时使用的重命名中缀: {task_id}.trash.<hex>
+_TRASH_INFIX = ".trash."
+
+
+def _fast_rmtree(path: str | os.PathLike) -> None:
+    """递归删除目录树，已不存在的条目跳过。
+
+    每个目录内的条目按 inode 号排序后再删除：反编译目录下有成千上万个小
+    smali 文件，按目录项顺序删除在 ext4 等文件系统上会退化为 O(n^2)，
+    按 inode 顺序则接近线性。符号链接只删除链接本身。
+
+    FileNotFoundError 按条目处理：遍历过程中被并发删除或移走的条目
+    （如 _discard_dir 的重命名）不会中断其余部分的删除。
+    """
+    try:
+        with os.scandir(path) as it:
+            entries = sorted(it, key=lambda e: e.inode())
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            _fast_rmtree(entry.path)
+        else:
+            try:
+                os.unlink(entry.path)
+            except FileNotFoundError:
+                pass
+    try:
+        os.rmdir(path)
+    except FileNotFoundError:
+        pass
+
+
+def _remove_file(path: Path) -> None:
+    """删除文件，不存在时忽略"""
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
 class StorageService:
     """存储服务：管理 APK 文件、缓存目录和输出文件"""
 
     # ZIP magic bytes: PK\x03\x04
     ZIP_MAGIC = b"PK\x03\x04"
 
+    # 流式上传每次读取/写入的块大小: 1 MiB
+    UPLOAD_CHUNK_SIZE = 1024 * 1024
+
     def __init__(self, base_dir: str = "data") -> None:
         self.base_dir = Path(base_dir)
         self.uploads_dir = self.base_dir / "uploads"
@@ -25,43 +117,100 @@ class StorageService:
         self._ensure_directories()
 
     def _ensure_directories(self) -> None:
-        """创建所需的目录结构"""
-        for d in [self.uploads_dir, self.cache_dir, self.workspace_dir, self.output_dir]:
-            d.mkdir(parents=True, exist_ok=True)
-
-    async def save_upload(self, file: UploadFile) -> str:
-        """保存上传的 APK 文件，返回 apk_id。
-
-        1. 读取文件内容
-        2. 验证 APK 格式 (ZIP magic + AndroidManifest.xml)
-        3. 生成 UUID 作为 apk_id
-        4. 保存到 data/uploads/{apk_id}.apk
-        5. 返回 apk_id
+        """创建所需的目录结构。
+
+        只对 base_dir 做一次逐级 makedirs，四个子目录直接 mkdir，
+        不再为每个子目录重复检查父目录链。
         """
-        content = await file.read()
+        os.makedirs(self.base_dir, exist_ok=True)
+        for d in (self.uploads_dir, self.cache_dir, self.workspace_dir, self.output_dir):
+            try:
+                os.mkdir(d)
+            except FileExistsError:
+                if not os.path.isdir(d):
+                    raise
+
+    async def save_upload(self, file: UploadFile, max_size: int | None = None) -> str:
+        """流式保存上传的 APK 文件，返回 apk_id。
 
-        self._validate_apk_format(content)
+        1. 生成 128 位随机十六进制串作为 apk_id
+        2. 读取第一块并检查 ZIP 魔数，不是 ZIP 时在写盘前直接拒绝
+        3. 按块读取上传内容，写入 data/uploads/{apk_id}.apk.part
+        4. 累计大小超过 max_size 时立即中止
+        5. 对落盘文件验证 AndroidManifest.xml 存在性
+        6. 重命名为 data/uploads/{apk_id}.apk 并返回 apk_id
 
-        apk_id = uuid.uuid4().hex
-        apk_path = self.uploads_dir / f"{apk_id}.apk"
-        apk_path.write_bytes(content)
+        内存占用为 O(块大小) 而非 O(文件大小)；任何失败都会删除临时文件。
+
+        Raises:
+            FileTooLargeError: 文件大小超过 max_size
+            ValueError: 文件不是有效的 APK 格式
+        """
+        chunk = await file.read(self.UPLOAD_CHUNK_SIZE)
+        if chunk[:4] != self.ZIP_MAGIC:
+            raise ValueError("文件不是有效的 ZIP 格式（缺少 PK 魔数）")
+
+        apk_id = secrets.token_hex(16)
+        apk_path = self.get_apk_path(apk_id)
+        part_path = apk_path.with_name(apk_path.name + ".part")
+
+        loop = asyncio.get_running_loop()
+        total = 0
+        try:
+            with open(part_path, "wb") as f:
+                while chunk:
+                    total += len(chunk)
+                    if max_size is not None and total > max_size:
+                        raise FileTooLargeError(f"文件大小超过限制 ({max_size} 字节)")
+                    await loop.run_in_executor(None, f.write, chunk)
+                    chunk = await file.read(self.UPLOAD_CHUNK_SIZE)
+
+            self._validate_apk_format(part_path)
+            os.replace(part_path, apk_path)
+        except BaseException:
+            part_path.unlink(missing_ok=True)
+            raise
 
         return apk_id
 
-    def _validate_apk_format(self, content: bytes) -> None:
-        """验证 APK 格式：检查 ZIP 魔数和 AndroidManifest.xml 存在性。
+    def _validate_apk_format(self, path: Path) -> None:
+        """验证已落盘的 APK：在 ZIP 中央目录中查找 AndroidManifest.xml。
+
+        ZIP 魔数已在读取第一块时检查过。这里只读取文件末尾的 EOCD 记录和中央目录
+        的原始字节，按字节查找条目名，不为每个条目构造 ZipInfo；遇到 zip64 等
+        少见格式时回退到 zipfile 完整解析。
 
         Raises:
             ValueError: 文件不是有效的 APK 格式
         """
-        if len(content) < 4 or content[:4] != self.ZIP_MAGIC:
-            raise ValueError("文件不是有效的 ZIP 格式（缺少 PK 魔数）")
+        with open(path, "rb") as f:
+            cd = _read_central_directory(f)
+        if cd is None:
+            self._validate_apk_format_zipfile(path)
+            return
+
+        # 中央目录文件头固定 46 字节，文件名紧随其后；核对签名和文件名长度，
+        # 排除名字恰好以 AndroidManifest.xml 结尾的其它条目
+        pos = cd.find(_MANIFEST_NAME)
+        while pos != -1:
+            header = pos - _CD_HEADER_SIZE
+            if (
+                header >= 0
+                and cd[header:header + 4] == _CD_SIGNATURE
+                and int.from_bytes(cd[header + 28:header + 30], "little") == len(_MANIFEST_NAME)
+            ):
+                return
+            pos = cd.find(_MANIFEST_NAME, pos + 1)
+        raise ValueError("ZIP 文件中缺少 AndroidManifest.xml，不是有效的 APK")
 
+    def _validate_apk_format_zipfile(self, path: Path) -> None:
+        """用 zipfile 完整解析中央目录来验证 APK（zip64 等情况的回退路径）"""
         try:
-            import io
-            with zipfile.ZipFile(io.BytesIO(content)) as zf:
-                if "AndroidManifest.xml" not in zf.namelist():
-                    raise ValueError("ZIP 文件中缺少 AndroidManifest.xml，不是有效的 APK")
+            with zipfile.ZipFile(path) as zf:
+                # getinfo 直接查 ZipFile 内部的名称字典，无需像 namelist() 那样构造完整列表
+                zf.getinfo("AndroidManifest.xml")
+        except KeyError:
+            raise ValueError("ZIP 文件中缺少 AndroidManifest.xml，不是有效的 APK")
         except zipfile.BadZipFile:
             raise ValueError("文件不是有效的 ZIP 格式")
 
@@ -77,6 +226,21 @@ class StorageService:
         """获取任务工作副本目录路径"""
         return self.workspace_dir / task_id
 
+    def purge_trash(self) -> None:
+        """删除 workspace 下残留的 {task_id}.trash.<hex> 目录。
+
+        失败任务的工作目录由 APKProcessor 重命名后在后台删除，进程在删除
+        完成前退出时会留下这些目录；任务记录只在内存中，重启后无从追踪，
+        因此在启动时整体清扫一次。
+        """
+        try:
+            with os.scandir(self.workspace_dir) as it:
+                trash = [e.path for e in it if _TRASH_INFIX in e.name]
+        except FileNotFoundError:
+            return
+        for path in trash:
+            _fast_rmtree(path)
+
     def get_output_path(self, task_id: str) -> Path:
         """获取修改后 APK 的输出路径"""
         return self.output_dir / f"{task_id}.apk"
@@ -92,16 +256,21 @@ class StorageService:
             包含 apk_id、filename、size、uploaded_at 的字典列表
         """
         apks: list[dict] = []
-        if not self.uploads_dir.exists():
+        try:
+            with os.scandir(self.uploads_dir) as it:
+                entries = [
+                    e for e in it
+                    if e.name.endswith(".apk") and e.is_file(follow_symlinks=False)
+                ]
+        except FileNotFoundError:
             return apks
 
-        for apk_file in sorted(self.uploads_dir.glob("*.apk")):
-            stat = apk_file.stat()
-            apk_id = apk_file.stem
+        for entry in sorted(entries, key=lambda e: e.name):
+            stat = entry.stat(follow_symlinks=False)
             apks.append(
                 {
-                    "apk_id": apk_id,
-                    "filename": apk_file.name,
+                    "apk_id": entry.name[:-len(".apk")],
+                    "filename": entry.name,
                     "size": stat.st_size,
                     "uploaded_at": datetime.fromtimestamp(
                         stat.st_mtime, tz=timezone.utc
@@ -117,23 +286,18 @@ class StorageService:
         1. 删除 data/uploads/{apk_id}.apk
         2. 删除 data/cache/{apk_id}/ 目录
         3. 删除 data/output/{task_id}.apk 和 data/workspace/{task_id}/ (每个关联 task)
-        """
-        # 删除原始 APK
-        apk_path = self.get_apk_path(apk_id)
-        if apk_path.exists():
-            apk_path.unlink()
 
-        # 删除缓存目录
-        cache_dir = self.get_cache_dir(apk_id)
-        if cache_dir.exists():
-            shutil.rmtree(cache_dir)
-
-        # 删除关联任务的输出和工作目录
+        各项删除互不依赖，全部放到线程池中并发执行，不阻塞事件循环。
+        """
+        targets = [
+            (_remove_file, self.get_apk_path(apk_id)),
+            (_fast_rmtree, self.get_cache_dir(apk_id)),
+        ]
         for task_id in task_ids:
-            output_path = self.get_output_path(task_id)
-            if output_path.exists():
-                output_path.unlink()
+            targets.append((_remove_file, self.get_output_path(task_id)))
+            targets.append((_fast_rmtree, self.get_work_dir(task_id)))
 
-            work_dir = self.get_work_dir(task_id)
-            if work_dir.exists():
-                shutil.rmtree(work_dir)
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(
+            *(loop.run_in_executor(None, remove, path) for remove, path in targets)
+        )
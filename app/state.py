@@ -1,5 +1,7 @@
 """Shared application state - in-memory stores and service instances."""
 
+import asyncio
+
 from app.services.apk_processor import APKProcessor
 from app.services.storage_service import StorageService
 
@@ -13,3 +15,26 @@ apk_metadata: dict[str, dict] = {}
 
 # task_id -> {"apk_id": str, "status": TaskStatus, "created_at": datetime, ...}
 tasks: dict[str, dict] = {}
+
+# apk_id -> task ids of that APK, in creation order (appended on create, dropped on APK delete)
+tasks_by_apk: dict[str, list[str]] = {}
+
+# apk_id -> serialized file tree response JSON (the cache never changes once built; dropped on APK delete)
+file_tree_cache: dict[str, bytes] = {}
+
+# Pending task jobs: (task_id, apk_id, rules), consumed by the workers started in lifespan
+task_queue: asyncio.Queue = asyncio.Queue()
+
+
+def add_task(task_id: str, record: dict) -> None:
+    """Register a new task in both tasks and the tasks_by_apk index."""
+    tasks[task_id] = record
+    tasks_by_apk.setdefault(record["apk_id"], []).append(task_id)
+
+
+def remove_apk_tasks(apk_id: str) -> list[str]:
+    """Remove all task records of an APK and return the removed task ids."""
+    task_ids = tasks_by_apk.pop(apk_id, [])
+    for task_id in task_ids:
+        tasks.pop(task_id, None)
+    return task_ids
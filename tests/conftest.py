@@ -0,0 +1,52 @@
+"""Shared pytest configuration."""
+
+import asyncio
+import os
+import shutil
+import tempfile
+from unittest.mock import AsyncMock
+
+import pytest
+
+# 规则引擎、处理器和存储测试都会在 tmp_path 下大量创建/读写/删除小文件。
+# 设置环境变量 APK_TEST_SHM=1（且未指定 --basetemp）时，本次运行的临时目录
+# 建在内存文件系统 /dev/shm 下，避免磁盘 IO；默认仍使用 pytest 的常规临时目录。
+_SHM_DIR = "/dev/shm"
+_SHM_ENV = "APK_TEST_SHM"
+_shm_basetemp: str | None = None
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_configure(config):
+    global _shm_basetemp
+    if os.environ.get(_SHM_ENV) != "1" or config.option.basetemp is not None:
+        return
+    if os.path.isdir(_SHM_DIR) and os.access(_SHM_DIR, os.W_OK):
+        # mkdtemp 为每次运行创建独立且仅属主可访问的目录，并发运行互不干扰
+        _shm_basetemp = tempfile.mkdtemp(prefix="pytest-", dir=_SHM_DIR)
+        config.option.basetemp = _shm_basetemp
+
+
+def pytest_unconfigure(config):
+    # /dev/shm 占用内存，运行结束即删除
+    if _shm_basetemp is not None:
+        shutil.rmtree(_shm_basetemp, ignore_errors=True)
+
+
+@pytest.fixture
+def fake_apktool():
+    """返回模拟 apktool 子进程的工厂：fake_apktool(returncode=0, stderr=b"")。
+
+    得到的进程对象 stderr 为已写入全部数据并关闭的流，可直接作为
+    asyncio.create_subprocess_exec 的返回值。
+    """
+
+    def make(returncode: int = 0, stderr: bytes = b"") -> AsyncMock:
+        process = AsyncMock()
+        process.stderr = asyncio.StreamReader()
+        process.stderr.feed_data(stderr)
+        process.stderr.feed_eof()
+        process.returncode = returncode
+        return process
+
+    return make
@@ -18,10 +18,14 @@ def _clean_state(tmp_path):
     original_processor = state.processor
     original_meta = state.apk_metadata
     original_tasks = state.tasks
+    original_file_trees = state.file_tree_cache
+    original_tasks_by_apk = state.tasks_by_apk
 
     state.storage = StorageService(base_dir=str(tmp_path / "data"))
     state.apk_metadata = {}
     state.tasks = {}
+    state.file_tree_cache = {}
+    state.tasks_by_apk = {}
 
     yield
 
@@ -29,6 +33,8 @@ def _clean_state(tmp_path):
     state.processor = original_processor
     state.apk_metadata = original_meta
     state.tasks = original_tasks
+    state.file_tree_cache = original_file_trees
+    state.tasks_by_apk = original_tasks_by_apk
 
 
 @pytest.fixture
@@ -99,6 +105,16 @@ class TestListAPKFiles:
         assert res_node["is_directory"] is True
         assert len(res_node["children"]) > 0
 
+    def test_file_tree_is_cached(self, client, ready_apk):
+        first = client.get(f"/api/v1/apks/{ready_apk}/files").json()["files"]
+        assert ready_apk in state.file_tree_cache
+
+        # Later changes on disk are not rescanned
+        decompiled = state.storage.get_cache_dir(ready_apk) / "decompiled"
+        (decompiled / "new.txt").write_text("x", encoding="utf-8")
+        second = client.get(f"/api/v1/apks/{ready_apk}/files").json()["files"]
+        assert second == first
+
 
 class TestReadAPKFile:
     """GET /api/v1/apks/{apk_id}/files/{path}"""
@@ -134,6 +150,11 @@ class TestReadAPKFile:
         assert resp.status_code == 404
         assert resp.json()["error"]["code"] == "FILE_NOT_FOUND"
 
+    def test_decompiled_root_itself_returns_404(self, client, ready_apk):
+        resp = client.get(f"/api/v1/apks/{ready_apk}/files/%2E")
+        assert resp.status_code == 404
+        assert resp.json()["error"]["code"] == "FILE_NOT_FOUND"
+
     def test_path_traversal_returns_400(self, client, ready_apk):
         # URL-encode the dots so they pass through to the handler as literal ".."
         resp = client.get(f"/api/v1/apks/{ready_apk}/files/res/..%2F..%2Fetc%2Fpasswd")
@@ -172,6 +193,8 @@ class TestListAPKTasks:
             "status": TaskStatus.PENDING,
             "created_at": now,
         }
+        state.tasks_by_apk[ready_apk] = ["task-1", "task-2"]
+        state.tasks_by_apk["other-apk"] = ["task-other"]
 
         resp = client.get(f"/api/v1/apks/{ready_apk}/tasks")
         assert resp.status_code == 200
@@ -188,6 +211,7 @@ class TestListAPKTasks:
             "created_at": now,
             "completed_at": now,
         }
+        state.tasks_by_apk[ready_apk] = ["task-x"]
 
         resp = client.get(f"/api/v1/apks/{ready_apk}/tasks")
         task = resp.json()["tasks"][0]
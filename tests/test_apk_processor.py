@@ -2,11 +2,13 @@
 
 import asyncio
 from pathlib import Path
-from unittest.mock import AsyncMock, MagicMock, patch
+from unittest.mock import patch
 
 import pytest
 
-from app.services.apk_processor import APKProcessor
+from app.models.schemas import ScriptRule
+from app.services.apk_processor import APKProcessor, _discard_dir, wait_for_discards
+from app.services.rule_engine import RuleEngine
 
 
 @pytest.fixture
@@ -18,22 +20,20 @@ def processor():
 
 
 @pytest.mark.asyncio
-async def test_decompile_to_cache_success(processor, tmp_path):
+async def test_decompile_to_cache_success(processor, tmp_path, fake_apktool):
     """apktool 成功时不抛异常，且传入正确参数"""
     apk_path = tmp_path / "test.apk"
     apk_path.write_bytes(b"fake apk content")
     cache_dir = tmp_path / "cache" / "abc123"
 
-    mock_process = AsyncMock()
-    mock_process.communicate.return_value = (b"success output", b"")
-    mock_process.returncode = 0
+    mock_process = fake_apktool()
 
     with patch("asyncio.create_subprocess_exec", return_value=mock_process) as mock_exec:
         await processor.decompile_to_cache(apk_path, cache_dir)
 
         mock_exec.assert_called_once_with(
             "apktool", "d", str(apk_path), "-o", str(cache_dir / "decompiled"), "-f",
-            stdout=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.DEVNULL,
             stderr=asyncio.subprocess.PIPE,
         )
 
@@ -42,15 +42,13 @@ async def test_decompile_to_cache_success(processor, tmp_path):
 
 
 @pytest.mark.asyncio
-async def test_decompile_to_cache_failure(processor, tmp_path):
+async def test_decompile_to_cache_failure(processor, tmp_path, fake_apktool):
     """apktool 失败时抛出 RuntimeError"""
     apk_path = tmp_path / "test.apk"
     apk_path.write_bytes(b"fake apk content")
     cache_dir = tmp_path / "cache" / "abc123"
 
-    mock_process = AsyncMock()
-    mock_process.communicate.return_value = (b"", b"brut.androlib.err: Could not decode")
-    mock_process.returncode = 1
+    mock_process = fake_apktool(1, b"brut.androlib.err: Could not decode")
 
     with patch("asyncio.create_subprocess_exec", return_value=mock_process):
         with pytest.raises(RuntimeError, match="apktool 反编译失败"):
@@ -58,15 +56,13 @@ async def test_decompile_to_cache_failure(processor, tmp_path):
 
 
 @pytest.mark.asyncio
-async def test_decompile_to_cache_creates_cache_dir(processor, tmp_path):
+async def test_decompile_to_cache_creates_cache_dir(processor, tmp_path, fake_apktool):
     """decompile_to_cache 应自动创建缓存目录"""
     apk_path = tmp_path / "test.apk"
     apk_path.write_bytes(b"fake")
     cache_dir = tmp_path / "deep" / "nested" / "cache"
 
-    mock_process = AsyncMock()
-    mock_process.communicate.return_value = (b"", b"")
-    mock_process.returncode = 0
+    mock_process = fake_apktool()
 
     with patch("asyncio.create_subprocess_exec", return_value=mock_process):
         await processor.decompile_to_cache(apk_path, cache_dir)
@@ -74,6 +70,66 @@ async def test_decompile_to_cache_creates_cache_dir(processor, tmp_path):
     assert cache_dir.exists()
 
 
+@pytest.mark.asyncio
+async def test_custom_apktool_command_prefix(tmp_path, fake_apktool):
+    """apktool_cmd 可替换为常驻 JVM 客户端等其他命令前缀"""
+    processor = APKProcessor(apktool_cmd=["ng", "brut.apktool.Main"])
+    apk_path = tmp_path / "test.apk"
+    cache_dir = tmp_path / "cache"
+
+    mock_process = fake_apktool()
+
+    with patch("asyncio.create_subprocess_exec", return_value=mock_process) as mock_exec:
+        await processor.decompile_to_cache(apk_path, cache_dir)
+
+    assert mock_exec.call_args.args[:3] == ("ng", "brut.apktool.Main", "d")
+
+
+@pytest.mark.asyncio
+async def test_apktool_runs_are_limited_by_max_concurrency(tmp_path, fake_apktool):
+    """超过并发上限的 apktool 调用应排队等待"""
+    processor = APKProcessor(max_concurrency=1)
+    active = 0
+    peak = 0
+
+    async def fake_exec(*args, **kwargs):
+        async def wait():
+            nonlocal active, peak
+            active += 1
+            peak = max(peak, active)
+            await asyncio.sleep(0.01)
+            active -= 1
+            return 0
+
+        process = fake_apktool()
+        process.wait = wait
+        return process
+
+    with patch("asyncio.create_subprocess_exec", side_effect=fake_exec):
+        await asyncio.gather(
+            processor.decompile_to_cache(tmp_path / "a.apk", tmp_path / "cache_a"),
+            processor.decompile_to_cache(tmp_path / "b.apk", tmp_path / "cache_b"),
+            processor.recompile(tmp_path / "src", tmp_path / "out.apk"),
+        )
+
+    assert peak == 1
+
+
+@pytest.mark.asyncio
+async def test_apktool_error_keeps_only_stderr_tail(processor, tmp_path, fake_apktool):
+    """stderr 很长时错误信息只保留末尾部分"""
+    stderr = b"I: noisy line\n" * 20000 + b"Exception: real cause"
+    mock_process = fake_apktool(1, stderr)
+
+    with patch("asyncio.create_subprocess_exec", return_value=mock_process):
+        with pytest.raises(RuntimeError) as exc_info:
+            await processor.decompile_to_cache(tmp_path / "a.apk", tmp_path / "cache")
+
+    message = str(exc_info.value)
+    assert message.endswith("Exception: real cause")
+    assert len(message) < len(stderr)
+
+
 # === copy_cache_to_workdir tests ===
 
 
@@ -112,13 +168,123 @@ async def test_copy_cache_to_workdir_does_not_modify_source(processor, tmp_path)
 
     await processor.copy_cache_to_workdir(cache_dir, work_dir)
 
-    # Modify the work copy
-    (work_dir / "file.txt").write_text("modified content")
+    # Modify the work copy through the rule engine (replace, never write in place)
+    rule = ScriptRule(target_path="file.txt", pattern="original", replacement="modified")
+    assert RuleEngine().apply_script_rule(work_dir, rule).success is True
+    assert (work_dir / "file.txt").read_text() == "modified content"
 
     # Source should be unchanged
     assert (cache_dir / "file.txt").read_text() == "original content"
 
 
+@pytest.mark.asyncio
+async def test_copy_cache_to_workdir_hardlinks_files(tmp_path):
+    """hardlink 策略应以 hardlink 共享缓存文件而非复制内容"""
+    processor = APKProcessor(clone_strategy="hardlink")
+    cache_dir = tmp_path / "cache"
+    (cache_dir / "decompiled").mkdir(parents=True)
+    (cache_dir / "decompiled" / "Main.smali").write_text(".class public LMain;")
+
+    work_dir = tmp_path / "work"
+
+    await processor.copy_cache_to_workdir(cache_dir, work_dir)
+
+    assert (work_dir / "decompiled" / "Main.smali").samefile(
+        cache_dir / "decompiled" / "Main.smali"
+    )
+
+
+@pytest.mark.asyncio
+async def test_copy_cache_to_workdir_copies_when_link_fails(processor, tmp_path):
+    """无法 hardlink 时应回退为独立副本（reflink 或普通复制），内容与 mtime 保持一致"""
+    cache_dir = tmp_path / "cache"
+    (cache_dir / "decompiled").mkdir(parents=True)
+    src = cache_dir / "decompiled" / "Main.smali"
+    src.write_text(".class public LMain;")
+
+    work_dir = tmp_path / "work"
+
+    with patch("app.services.apk_processor.os.link", side_effect=OSError("EXDEV")):
+        await processor.copy_cache_to_workdir(cache_dir, work_dir)
+
+    dst = work_dir / "decompiled" / "Main.smali"
+    assert dst.read_text() == ".class public LMain;"
+    assert not dst.samefile(src)
+    assert dst.stat().st_mtime_ns == src.stat().st_mtime_ns
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("strategy", ["reflink", "copy"])
+async def test_copy_cache_to_workdir_clone_strategy(strategy, tmp_path):
+    """reflink / copy 策略应生成独立于缓存的文件"""
+    processor = APKProcessor(clone_strategy=strategy)
+    cache_dir = tmp_path / "cache"
+    (cache_dir / "decompiled").mkdir(parents=True)
+    src = cache_dir / "decompiled" / "Main.smali"
+    src.write_text(".class public LMain;")
+
+    work_dir = tmp_path / "work"
+    await processor.copy_cache_to_workdir(cache_dir, work_dir)
+
+    dst = work_dir / "decompiled" / "Main.smali"
+    assert dst.read_text() == ".class public LMain;"
+    assert not dst.samefile(src)
+
+
+@pytest.mark.asyncio
+async def test_auto_clone_falls_back_to_hardlink_without_reflink(tmp_path):
+    """auto 策略在 reflink 不可用时改用 hardlink，且只探测一次"""
+    processor = APKProcessor(clone_strategy="auto")
+    cache_dir = tmp_path / "cache"
+    (cache_dir / "decompiled").mkdir(parents=True)
+    for name in ("A.smali", "B.smali", "C.smali"):
+        (cache_dir / "decompiled" / name).write_text(name)
+
+    work_dir = tmp_path / "work"
+    with patch(
+        "app.services.apk_processor._reflink", return_value=False
+    ) as mock_reflink:
+        await processor.copy_cache_to_workdir(cache_dir, work_dir)
+
+    assert mock_reflink.call_count == 1
+    for name in ("A.smali", "B.smali", "C.smali"):
+        assert (work_dir / "decompiled" / name).samefile(cache_dir / "decompiled" / name)
+
+
+def test_unknown_clone_strategy_rejected():
+    with pytest.raises(ValueError, match="clone_strategy"):
+        APKProcessor(clone_strategy="symlink")
+
+
+@pytest.mark.asyncio
+async def test_discard_dir_deletes_in_background_when_rename_fails(tmp_path):
+    """无法重命名时也在线程池中删除原目录"""
+    work_dir = tmp_path / "work"
+    (work_dir / "smali").mkdir(parents=True)
+    (work_dir / "smali" / "Main.smali").write_text(".class")
+
+    with patch("app.services.apk_processor.os.rename", side_effect=PermissionError("busy")), \
+            patch("app.services.apk_processor._fast_rmtree") as mock_rmtree:
+        _discard_dir(work_dir)
+        await wait_for_discards()
+
+    mock_rmtree.assert_called_once_with(work_dir)
+
+
+@pytest.mark.asyncio
+async def test_discard_dir_logs_background_failure(tmp_path, caplog):
+    """后台删除失败时记录错误日志"""
+    work_dir = tmp_path / "work"
+    work_dir.mkdir()
+
+    with patch("app.services.apk_processor._fast_rmtree", side_effect=OSError("disk error")):
+        _discard_dir(work_dir)
+        await wait_for_discards()
+        await asyncio.sleep(0)  # done 回调在下一轮事件循环中执行
+
+    assert "后台删除工作目录失败" in caplog.text
+
+
 @pytest.mark.asyncio
 async def test_copy_cache_to_workdir_fails_if_source_missing(processor, tmp_path):
     """源目录不存在时应抛出 RuntimeError"""
@@ -147,22 +313,20 @@ async def test_copy_cache_to_workdir_fails_if_dest_exists(processor, tmp_path):
 
 
 @pytest.mark.asyncio
-async def test_recompile_success(processor, tmp_path):
+async def test_recompile_success(processor, tmp_path, fake_apktool):
     """apktool b 成功时不抛异常，且传入正确参数"""
     source_dir = tmp_path / "workspace" / "task001" / "decompiled"
     source_dir.mkdir(parents=True)
     output_apk = tmp_path / "output" / "task001.apk"
 
-    mock_process = AsyncMock()
-    mock_process.communicate.return_value = (b"built successfully", b"")
-    mock_process.returncode = 0
+    mock_process = fake_apktool()
 
     with patch("asyncio.create_subprocess_exec", return_value=mock_process) as mock_exec:
         await processor.recompile(source_dir, output_apk)
 
         mock_exec.assert_called_once_with(
             "apktool", "b", str(source_dir), "-o", str(output_apk),
-            stdout=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.DEVNULL,
             stderr=asyncio.subprocess.PIPE,
         )
 
@@ -171,15 +335,13 @@ async def test_recompile_success(processor, tmp_path):
 
 
 @pytest.mark.asyncio
-async def test_recompile_failure(processor, tmp_path):
+async def test_recompile_failure(processor, tmp_path, fake_apktool):
     """apktool b 失败时抛出 RuntimeError"""
     source_dir = tmp_path / "workspace" / "task001" / "decompiled"
     source_dir.mkdir(parents=True)
     output_apk = tmp_path / "output" / "task001.apk"
 
-    mock_process = AsyncMock()
-    mock_process.communicate.return_value = (b"", b"Error: missing apktool.yml")
-    mock_process.returncode = 1
+    mock_process = fake_apktool(1, b"Error: missing apktool.yml")
 
     with patch("asyncio.create_subprocess_exec", return_value=mock_process):
         with pytest.raises(RuntimeError, match="apktool 重新打包失败"):
@@ -187,15 +349,13 @@ async def test_recompile_failure(processor, tmp_path):
 
 
 @pytest.mark.asyncio
-async def test_recompile_creates_output_parent_dir(processor, tmp_path):
+async def test_recompile_creates_output_parent_dir(processor, tmp_path, fake_apktool):
     """recompile 应自动创建输出文件的父目录"""
     source_dir = tmp_path / "src"
     source_dir.mkdir()
     output_apk = tmp_path / "deep" / "nested" / "output.apk"
 
-    mock_process = AsyncMock()
-    mock_process.communicate.return_value = (b"", b"")
-    mock_process.returncode = 0
+    mock_process = fake_apktool()
 
     with patch("asyncio.create_subprocess_exec", return_value=mock_process):
         await processor.recompile(source_dir, output_apk)
@@ -204,15 +364,44 @@ async def test_recompile_creates_output_parent_dir(processor, tmp_path):
 
 
 @pytest.mark.asyncio
-async def test_recompile_error_includes_stderr(processor, tmp_path):
+async def test_recompile_in_place_writes_do_not_modify_cache(tmp_path, fake_apktool):
+    """apktool b 原地改写 AndroidManifest.xml / apktool.yml 时，hardlink 的缓存不受影响"""
+    processor = APKProcessor(clone_strategy="hardlink")
+    cache_dir = tmp_path / "cache"
+    (cache_dir / "decompiled").mkdir(parents=True)
+    (cache_dir / "decompiled" / "AndroidManifest.xml").write_text("<manifest/>")
+    (cache_dir / "decompiled" / "apktool.yml").write_text("version: 2.9.3")
+    (cache_dir / "decompiled" / "Main.smali").write_text(".class public LMain;")
+
+    work_dir = tmp_path / "work"
+    await processor.copy_cache_to_workdir(cache_dir, work_dir)
+    source_dir = work_dir / "decompiled"
+
+    def apktool_build(*args, **kwargs):
+        # 模拟 apktool 直接打开源文件原地写入
+        for name in ("AndroidManifest.xml", "apktool.yml"):
+            with open(source_dir / name, "r+b") as f:
+                f.write(b"PATCHED")
+        return fake_apktool()
+
+    with patch("asyncio.create_subprocess_exec", side_effect=apktool_build):
+        await processor.recompile(source_dir, tmp_path / "out.apk")
+
+    assert (cache_dir / "decompiled" / "AndroidManifest.xml").read_text() == "<manifest/>"
+    assert (cache_dir / "decompiled" / "apktool.yml").read_text() == "version: 2.9.3"
+    assert (source_dir / "AndroidManifest.xml").read_bytes().startswith(b"PATCHED")
+    # 其它文件仍与缓存共享 inode
+    assert (source_dir / "Main.smali").samefile(cache_dir / "decompiled" / "Main.smali")
+
+
+@pytest.mark.asyncio
+async def test_recompile_error_includes_stderr(processor, tmp_path, fake_apktool):
     """RuntimeError 应包含 stderr 中的错误信息"""
     source_dir = tmp_path / "src"
     source_dir.mkdir()
     output_apk = tmp_path / "out.apk"
 
-    mock_process = AsyncMock()
-    mock_process.communicate.return_value = (b"", b"specific error detail here")
-    mock_process.returncode = 2
+    mock_process = fake_apktool(2, b"specific error detail here")
 
     with patch("asyncio.create_subprocess_exec", return_value=mock_process):
         with pytest.raises(RuntimeError, match="specific error detail here"):
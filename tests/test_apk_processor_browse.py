@@ -1,5 +1,7 @@
 """Tests for APKProcessor cache browsing functionality (list_files_from_cache, read_file_from_cache)."""
 
+import os
+
 import pytest
 from pathlib import Path
 
@@ -112,6 +114,34 @@ class TestListFilesFromCache:
         assert main_node.path == "smali/com/example/Main.smali"
 
 
+class TestFileTreeIndex:
+    def test_index_written_after_first_listing(self, processor, cache_dir):
+        nodes = processor.list_files_from_cache(cache_dir)
+        assert (cache_dir / "files.json").is_file()
+        assert processor.list_files_from_cache(cache_dir) == nodes
+
+    def test_index_reused_while_mtime_unchanged(self, processor, cache_dir):
+        processor.list_files_from_cache(cache_dir)
+        # A file added deep in the tree does not touch decompiled/'s mtime,
+        # so the stored listing is served as-is
+        (cache_dir / "decompiled" / "res" / "extra.txt").write_text("x")
+        nodes = processor.list_files_from_cache(cache_dir)
+        res = next(n for n in nodes if n.name == "res")
+        assert "extra.txt" not in [c.name for c in res.children]
+
+    def test_index_rebuilt_when_mtime_changes(self, processor, cache_dir):
+        processor.list_files_from_cache(cache_dir)
+        (cache_dir / "decompiled" / "new.txt").write_text("x")
+        os.utime(cache_dir / "decompiled", ns=(0, 0))
+        nodes = processor.list_files_from_cache(cache_dir)
+        assert "new.txt" in [n.name for n in nodes]
+
+    def test_corrupt_index_ignored(self, processor, cache_dir):
+        (cache_dir / "files.json").write_text("not json")
+        nodes = processor.list_files_from_cache(cache_dir)
+        assert "AndroidManifest.xml" in [n.name for n in nodes]
+
+
 # === read_file_from_cache tests ===
 
 
@@ -144,6 +174,38 @@ class TestReadFileFromCache:
         with pytest.raises(FileNotFoundError):
             processor.read_file_from_cache(cache_dir, "res/values")
 
+    @pytest.mark.parametrize("path", ["", ".", "./", "./."])
+    def test_decompiled_root_itself_not_found(self, processor, cache_dir, path):
+        with pytest.raises(FileNotFoundError):
+            processor.read_file_from_cache(cache_dir, path)
+
     def test_read_deeply_nested_file(self, processor, cache_dir):
         content = processor.read_file_from_cache(cache_dir, "smali/com/example/Main.smali")
         assert "Lcom/example/Main" in content
+
+    def test_read_large_file(self, processor, cache_dir):
+        content = "const-string v0, \"é\"\n" * 100_000
+        assert len(content.encode("utf-8")) > 1024 * 1024
+        (cache_dir / "decompiled" / "Big.smali").write_text(content, encoding="utf-8")
+        assert processor.read_file_from_cache(cache_dir, "Big.smali") == content
+
+    def test_directory_path_not_found(self, processor, cache_dir):
+        with pytest.raises(FileNotFoundError):
+            processor.read_file_from_cache(cache_dir, "res/values")
+
+    def test_dots_inside_file_name_allowed(self, processor, cache_dir):
+        (cache_dir / "decompiled" / "a..b.txt").write_text("dots", encoding="utf-8")
+        assert processor.read_file_from_cache(cache_dir, "a..b.txt") == "dots"
+
+    def test_precomputed_decompiled_root(self, processor, cache_dir):
+        root = str((cache_dir / "decompiled").resolve())
+        content = processor.read_file_from_cache(cache_dir, "AndroidManifest.xml", root)
+        assert content == "<manifest/>"
+
+    def test_sibling_directory_with_same_prefix_rejected(self, processor, cache_dir):
+        sibling = cache_dir / "decompiled-other"
+        sibling.mkdir()
+        (sibling / "secret.txt").write_text("secret", encoding="utf-8")
+        (cache_dir / "decompiled" / "link").symlink_to(sibling)
+        with pytest.raises(ValueError):
+            processor.read_file_from_cache(cache_dir, "link/secret.txt")
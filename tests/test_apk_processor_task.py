@@ -3,12 +3,12 @@
 import asyncio
 import base64
 from pathlib import Path
-from unittest.mock import AsyncMock, patch
+from unittest.mock import patch
 
 import pytest
 
 from app.models.schemas import ImageRule, RuleResult, ScriptRule
-from app.services.apk_processor import APKProcessor
+from app.services.apk_processor import APKProcessor, wait_for_discards
 
 
 @pytest.fixture
@@ -49,20 +49,12 @@ def output_path(tmp_path):
     return tmp_path / "output" / "task001.apk"
 
 
-def _mock_recompile_success():
-    """Return a mock for recompile that succeeds."""
-    mock_process = AsyncMock()
-    mock_process.communicate.return_value = (b"", b"")
-    mock_process.returncode = 0
-    return mock_process
-
-
 # === process_task: happy path ===
 
 
 @pytest.mark.asyncio
 async def test_process_task_copies_cache_and_applies_script_rule(
-    processor, cache_dir, work_dir, output_path
+    processor, cache_dir, work_dir, output_path, fake_apktool
 ):
     """process_task should copy cache, apply script rules, and recompile."""
     rules = [
@@ -73,7 +65,7 @@ async def test_process_task_copies_cache_and_applies_script_rule(
         )
     ]
 
-    with patch("asyncio.create_subprocess_exec", return_value=_mock_recompile_success()):
+    with patch("asyncio.create_subprocess_exec", return_value=fake_apktool()):
         results = await processor.process_task(cache_dir, work_dir, output_path, rules)
 
     assert len(results) == 1
@@ -90,7 +82,7 @@ async def test_process_task_copies_cache_and_applies_script_rule(
 
 @pytest.mark.asyncio
 async def test_process_task_applies_image_rule(
-    processor, cache_dir, work_dir, output_path
+    processor, cache_dir, work_dir, output_path, fake_apktool
 ):
     """process_task should apply image replacement rules."""
     new_image_data = base64.b64encode(b"\x89PNG new icon data").decode()
@@ -101,7 +93,7 @@ async def test_process_task_applies_image_rule(
         )
     ]
 
-    with patch("asyncio.create_subprocess_exec", return_value=_mock_recompile_success()):
+    with patch("asyncio.create_subprocess_exec", return_value=fake_apktool()):
         results = await processor.process_task(cache_dir, work_dir, output_path, rules)
 
     assert len(results) == 1
@@ -114,7 +106,7 @@ async def test_process_task_applies_image_rule(
 
 @pytest.mark.asyncio
 async def test_process_task_applies_multiple_rules_in_order(
-    processor, cache_dir, work_dir, output_path
+    processor, cache_dir, work_dir, output_path, fake_apktool
 ):
     """process_task should apply multiple rules sequentially with correct indices."""
     new_image_data = base64.b64encode(b"replaced").decode()
@@ -135,7 +127,7 @@ async def test_process_task_applies_multiple_rules_in_order(
         ),
     ]
 
-    with patch("asyncio.create_subprocess_exec", return_value=_mock_recompile_success()):
+    with patch("asyncio.create_subprocess_exec", return_value=fake_apktool()):
         results = await processor.process_task(cache_dir, work_dir, output_path, rules)
 
     assert len(results) == 3
@@ -149,9 +141,9 @@ async def test_process_task_applies_multiple_rules_in_order(
 
 
 @pytest.mark.asyncio
-async def test_process_task_empty_rules(processor, cache_dir, work_dir, output_path):
+async def test_process_task_empty_rules(processor, cache_dir, work_dir, output_path, fake_apktool):
     """process_task with no rules should still copy and recompile."""
-    with patch("asyncio.create_subprocess_exec", return_value=_mock_recompile_success()):
+    with patch("asyncio.create_subprocess_exec", return_value=fake_apktool()):
         results = await processor.process_task(cache_dir, work_dir, output_path, [])
 
     assert results == []
@@ -164,7 +156,7 @@ async def test_process_task_empty_rules(processor, cache_dir, work_dir, output_p
 
 @pytest.mark.asyncio
 async def test_process_task_continues_on_rule_failure(
-    processor, cache_dir, work_dir, output_path
+    processor, cache_dir, work_dir, output_path, fake_apktool
 ):
     """When a rule targets a nonexistent file, it should fail but other rules continue."""
     rules = [
@@ -180,7 +172,7 @@ async def test_process_task_continues_on_rule_failure(
         ),
     ]
 
-    with patch("asyncio.create_subprocess_exec", return_value=_mock_recompile_success()):
+    with patch("asyncio.create_subprocess_exec", return_value=fake_apktool()):
         results = await processor.process_task(cache_dir, work_dir, output_path, rules)
 
     assert len(results) == 2
@@ -192,7 +184,7 @@ async def test_process_task_continues_on_rule_failure(
 
 @pytest.mark.asyncio
 async def test_process_task_all_rules_fail_still_recompiles(
-    processor, cache_dir, work_dir, output_path
+    processor, cache_dir, work_dir, output_path, fake_apktool
 ):
     """Even if all rules fail, recompile should still be attempted."""
     rules = [
@@ -200,7 +192,7 @@ async def test_process_task_all_rules_fail_still_recompiles(
         ScriptRule(target_path="missing2.txt", pattern="c", replacement="d"),
     ]
 
-    with patch("asyncio.create_subprocess_exec", return_value=_mock_recompile_success()) as mock_exec:
+    with patch("asyncio.create_subprocess_exec", return_value=fake_apktool()) as mock_exec:
         results = await processor.process_task(cache_dir, work_dir, output_path, rules)
 
     assert all(not r.success for r in results)
@@ -213,7 +205,7 @@ async def test_process_task_all_rules_fail_still_recompiles(
 
 @pytest.mark.asyncio
 async def test_process_task_does_not_modify_cache(
-    processor, cache_dir, work_dir, output_path
+    processor, cache_dir, work_dir, output_path, fake_apktool
 ):
     """Cache directory must remain unchanged after process_task."""
     original_content = (cache_dir / "decompiled" / "res" / "values" / "strings.xml").read_text(
@@ -231,7 +223,7 @@ async def test_process_task_does_not_modify_cache(
         ImageRule(target_path="res/drawable/icon.png", image_data=new_image),
     ]
 
-    with patch("asyncio.create_subprocess_exec", return_value=_mock_recompile_success()):
+    with patch("asyncio.create_subprocess_exec", return_value=fake_apktool()):
         await processor.process_task(cache_dir, work_dir, output_path, rules)
 
     # Cache must be untouched
@@ -259,7 +251,7 @@ async def test_process_task_cleans_workdir_on_copy_failure(processor, tmp_path):
 
 @pytest.mark.asyncio
 async def test_process_task_cleans_workdir_on_recompile_failure(
-    processor, cache_dir, work_dir, output_path
+    processor, cache_dir, work_dir, output_path, fake_apktool
 ):
     """If recompile fails, work_dir should be cleaned up and error re-raised."""
     rules = [
@@ -270,9 +262,7 @@ async def test_process_task_cleans_workdir_on_recompile_failure(
         )
     ]
 
-    mock_process = AsyncMock()
-    mock_process.communicate.return_value = (b"", b"recompile error detail")
-    mock_process.returncode = 1
+    mock_process = fake_apktool(1, b"recompile error detail")
 
     with patch("asyncio.create_subprocess_exec", return_value=mock_process):
         with pytest.raises(RuntimeError, match="apktool 重新打包失败"):
@@ -281,13 +271,17 @@ async def test_process_task_cleans_workdir_on_recompile_failure(
     # Work dir should have been cleaned up
     assert not work_dir.exists()
 
+    # The renamed-away copy is removed in the background
+    await wait_for_discards()
+    assert not list(work_dir.parent.glob(f"{work_dir.name}.trash.*"))
+
 
 # === process_task: regex script rule ===
 
 
 @pytest.mark.asyncio
 async def test_process_task_regex_script_rule(
-    processor, cache_dir, work_dir, output_path
+    processor, cache_dir, work_dir, output_path, fake_apktool
 ):
     """process_task should support regex-based script rules."""
     rules = [
@@ -299,7 +293,7 @@ async def test_process_task_regex_script_rule(
         )
     ]
 
-    with patch("asyncio.create_subprocess_exec", return_value=_mock_recompile_success()):
+    with patch("asyncio.create_subprocess_exec", return_value=fake_apktool()):
         results = await processor.process_task(cache_dir, work_dir, output_path, rules)
 
     assert results[0].success is True
@@ -307,3 +301,29 @@ async def test_process_task_regex_script_rule(
         encoding="utf-8"
     )
     assert "ReplacedApp" in content
+
+
+# === process_task: rules grouped by target file ===
+
+
+@pytest.mark.asyncio
+async def test_process_task_keeps_order_for_rules_on_same_file(
+    processor, cache_dir, work_dir, output_path, fake_apktool
+):
+    """Rules targeting the same file must run in their original order."""
+    rules = [
+        ScriptRule(target_path="res/values/strings.xml", pattern="OldName", replacement="Mid"),
+        ScriptRule(target_path="AndroidManifest.xml", pattern="example", replacement="demo"),
+        ScriptRule(target_path="res/values/strings.xml", pattern="Mid", replacement="Final"),
+    ]
+
+    with patch("asyncio.create_subprocess_exec", return_value=fake_apktool()):
+        results = await processor.process_task(cache_dir, work_dir, output_path, rules)
+
+    assert [r.rule_index for r in results] == [0, 1, 2]
+    assert all(r.success for r in results)
+    content = (work_dir / "decompiled" / "res" / "values" / "strings.xml").read_text(
+        encoding="utf-8"
+    )
+    assert "Final" in content
+    assert "Mid" not in content
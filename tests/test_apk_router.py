@@ -1,6 +1,8 @@
 """Unit tests for APK upload and management routes."""
 
+import functools
 import io
+import os
 import zipfile
 from unittest.mock import AsyncMock, patch
 
@@ -19,12 +21,16 @@ def _clean_state(tmp_path):
     original_processor = state.processor
     original_meta = state.apk_metadata
     original_tasks = state.tasks
+    original_file_trees = state.file_tree_cache
+    original_tasks_by_apk = state.tasks_by_apk
 
     # Use temp storage
     from app.services.storage_service import StorageService
     state.storage = StorageService(base_dir=str(tmp_path / "data"))
     state.apk_metadata = {}
     state.tasks = {}
+    state.file_tree_cache = {}
+    state.tasks_by_apk = {}
 
     yield
 
@@ -32,15 +38,18 @@ def _clean_state(tmp_path):
     state.processor = original_processor
     state.apk_metadata = original_meta
     state.tasks = original_tasks
+    state.file_tree_cache = original_file_trees
+    state.tasks_by_apk = original_tasks_by_apk
 
 
-@pytest.fixture
+@pytest.fixture(scope="module")
 def client():
     return TestClient(app)
 
 
+@functools.cache
 def _make_apk_bytes() -> bytes:
-    """Create a minimal valid APK (ZIP with AndroidManifest.xml)."""
+    """Create a minimal valid APK (ZIP with AndroidManifest.xml), built once per module."""
     buf = io.BytesIO()
     with zipfile.ZipFile(buf, "w") as zf:
         zf.writestr("AndroidManifest.xml", "<manifest/>")
@@ -77,6 +86,8 @@ class TestUploadAPK:
 
         # Verify metadata was stored
         assert body["apk_id"] in state.apk_metadata
+        meta = state.apk_metadata[body["apk_id"]]
+        assert meta["decompiled_root"].endswith("decompiled")
 
     def test_invalid_format_returns_400(self, client):
         resp = client.post(
@@ -125,8 +136,8 @@ class TestUploadAPK:
         assert resp.json()["error"]["code"] == "DECOMPILE_ERROR"
 
         # The APK file should have been cleaned up
-        apk_files = list(state.storage.uploads_dir.glob("*.apk"))
-        assert len(apk_files) == 0
+        apk_files = [n for n in os.listdir(state.storage.uploads_dir) if n.endswith(".apk")]
+        assert apk_files == []
 
 
 class TestListAPKs:
@@ -171,6 +182,7 @@ class TestListAPKs:
         # Simulate tasks in state
         state.tasks["task-1"] = {"apk_id": apk_id, "status": "completed"}
         state.tasks["task-2"] = {"apk_id": apk_id, "status": "pending"}
+        state.tasks_by_apk[apk_id] = ["task-1", "task-2"]
 
         resp = client.get("/api/v1/apks")
         apks = resp.json()["apks"]
@@ -198,6 +210,7 @@ class TestDeleteAPK:
 
         # Add a fake task
         state.tasks["task-x"] = {"apk_id": apk_id, "status": "completed"}
+        state.tasks_by_apk[apk_id] = ["task-x"]
 
         resp = client.delete(f"/api/v1/apks/{apk_id}")
         assert resp.status_code == 200
@@ -206,6 +219,32 @@ class TestDeleteAPK:
         # Metadata and tasks should be cleaned up
         assert apk_id not in state.apk_metadata
         assert "task-x" not in state.tasks
+        assert apk_id not in state.tasks_by_apk
 
         # File should be gone
         assert not state.storage.get_apk_path(apk_id).exists()
+
+    @patch.object(state, "processor")
+    def test_task_records_dropped_before_storage_delete(self, mock_processor, client):
+        mock_processor.decompile_to_cache = AsyncMock()
+
+        upload_resp = client.post(
+            "/api/v1/apks",
+            files={"file": ("del.apk", _make_apk_bytes(), "application/octet-stream")},
+        )
+        apk_id = upload_resp.json()["apk_id"]
+        state.tasks["task-x"] = {"apk_id": apk_id, "status": "pending"}
+        state.tasks_by_apk[apk_id] = ["task-x"]
+
+        seen = {}
+
+        async def delete_apk(deleted_apk_id, task_ids):
+            # Queued workers look the task up while storage is being removed
+            seen["task_ids"] = task_ids
+            seen["task_alive"] = "task-x" in state.tasks
+
+        with patch.object(state.storage, "delete_apk", side_effect=delete_apk):
+            resp = client.delete(f"/api/v1/apks/{apk_id}")
+
+        assert resp.status_code == 200
+        assert seen == {"task_ids": ["task-x"], "task_alive": False}
@@ -7,7 +7,7 @@ from fastapi.testclient import TestClient
 from app.main import app
 
 
-@pytest.fixture
+@pytest.fixture(scope="module")
 def client():
     return TestClient(app)
 
@@ -41,6 +41,8 @@ class TestGlobalExceptionHandler:
         async def _raise():
             raise RuntimeError("boom")
 
+        # Snapshot the existing route objects so they are restored as-is afterwards
+        original_routes = list(app.router.routes)
         app.include_router(test_router)
         try:
             client = TestClient(app, raise_server_exceptions=False)
@@ -52,4 +54,4 @@ class TestGlobalExceptionHandler:
             assert body["error"]["details"] == {}
         finally:
             # Clean up the temporary route
-            app.routes[:] = [r for r in app.routes if getattr(r, "path", "") != "/_test_error"]
+            app.router.routes[:] = original_routes
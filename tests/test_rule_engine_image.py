@@ -8,7 +8,7 @@ from app.models.schemas import ImageRule
 from app.services.rule_engine import RuleEngine
 
 
-@pytest.fixture
+@pytest.fixture(scope="module")
 def engine():
     return RuleEngine()
 
@@ -78,6 +78,21 @@ class TestApplyImageRuleSuccess:
 
         assert result.rule_index == 0
 
+    def test_hardlinked_file_is_not_modified_in_place(self, engine, tmp_path):
+        """目标文件为 hardlink 时，替换不应影响另一个链接"""
+        original = tmp_path / "cache.png"
+        original.write_bytes(b"old image")
+        work = tmp_path / "work"
+        work.mkdir()
+        (work / "icon.png").hardlink_to(original)
+
+        rule = ImageRule(target_path="icon.png", image_data=_encode(b"new image"))
+        result = engine.apply_image_rule(work, rule)
+
+        assert result.success is True
+        assert (work / "icon.png").read_bytes() == b"new image"
+        assert original.read_bytes() == b"old image"
+
 
 class TestApplyImageRuleFileNotFound:
     """目标文件不存在"""
@@ -145,3 +160,50 @@ class TestApplyImageRuleEdgeCases:
 
         assert result.success is False
         assert "img.png" in result.message
+
+    def test_invalid_base64_leaves_target_untouched(self, engine, tmp_path):
+        """解码失败时目标文件保持原样且不留下临时文件"""
+        target = tmp_path / "img.png"
+        target.write_bytes(b"original")
+
+        rule = ImageRule(target_path="img.png", image_data="!!!not-base64!!!")
+        engine.apply_image_rule(tmp_path, rule)
+
+        assert target.read_bytes() == b"original"
+        assert [p.name for p in tmp_path.iterdir()] == ["img.png"]
+
+    def test_data_spanning_multiple_decode_chunks(self, engine, tmp_path, monkeypatch):
+        """跨多个解码块的数据应完整写入"""
+        monkeypatch.setattr("app.services.rule_engine._B64_CHUNK_CHARS", 8)
+        target = tmp_path / "multi.png"
+        target.write_bytes(b"old")
+
+        new_data = bytes(range(100))
+        rule = ImageRule(target_path="multi.png", image_data=_encode(new_data))
+        result = engine.apply_image_rule(tmp_path, rule)
+
+        assert result.success is True
+        assert target.read_bytes() == new_data
+
+    def test_invalid_characters_are_rejected_not_skipped(self, engine, tmp_path):
+        """夹杂非法字符的数据应失败，而不是丢弃非法字符后继续解码"""
+        target = tmp_path / "img.png"
+        target.write_bytes(b"original")
+
+        rule = ImageRule(target_path="img.png", image_data="YW*Jj")
+        result = engine.apply_image_rule(tmp_path, rule)
+
+        assert result.success is False
+        assert target.read_bytes() == b"original"
+
+    def test_excess_padding_decoded_whole(self, engine, tmp_path, monkeypatch):
+        """完整分组后多余的 '=' 不会被分块切成只有填充的一块"""
+        monkeypatch.setattr("app.services.rule_engine._B64_CHUNK_CHARS", 4)
+        target = tmp_path / "img.png"
+        target.write_bytes(b"old")
+
+        rule = ImageRule(target_path="img.png", image_data="QUJD==")
+        result = engine.apply_image_rule(tmp_path, rule)
+
+        assert result.success is True
+        assert target.read_bytes() == b"ABC"
@@ -1,12 +1,15 @@
-"""RuleEngine.apply_script_rule() 单元测试"""
+"""RuleEngine.apply_script_rule() / apply_script_rules() 单元测试"""
+
+from unittest.mock import patch
 
 import pytest
 
 from app.models.schemas import ScriptRule
+from app.services import rule_engine
 from app.services.rule_engine import RuleEngine
 
 
-@pytest.fixture
+@pytest.fixture(scope="module")
 def engine():
     return RuleEngine()
 
@@ -51,6 +54,21 @@ class TestApplyScriptRulePlainText:
         assert result.success is True
         assert target.read_text(encoding="utf-8") == original
 
+    def test_no_match_does_not_rewrite_file(self, engine, tmp_path):
+        target = tmp_path / "test.txt"
+        target.write_text("nothing to replace here", encoding="utf-8")
+        inode_before = target.stat().st_ino
+
+        rule = ScriptRule(
+            target_path="test.txt", pattern="missing", replacement="found"
+        )
+        result = engine.apply_script_rule(tmp_path, rule)
+
+        assert result.success is True
+        assert "未修改" in result.message
+        # The file was not replaced by a new one
+        assert target.stat().st_ino == inode_before
+
     def test_nested_path(self, engine, tmp_path):
         subdir = tmp_path / "res" / "values"
         subdir.mkdir(parents=True)
@@ -67,6 +85,18 @@ class TestApplyScriptRulePlainText:
         assert result.success is True
         assert "NewName" in target.read_text(encoding="utf-8")
 
+    def test_non_ascii_replacement(self, engine, tmp_path):
+        target = tmp_path / "strings.xml"
+        target.write_text('<string name="app">旧名称</string>', encoding="utf-8")
+
+        rule = ScriptRule(
+            target_path="strings.xml", pattern="旧名称", replacement="新名称"
+        )
+        result = engine.apply_script_rule(tmp_path, rule)
+
+        assert result.success is True
+        assert target.read_text(encoding="utf-8") == '<string name="app">新名称</string>'
+
 
 class TestApplyScriptRuleRegex:
     """正则表达式匹配替换"""
@@ -175,3 +205,127 @@ class TestApplyScriptRuleEdgeCases:
         result = engine.apply_script_rule(tmp_path, rule)
 
         assert result.rule_index == 0
+
+    def test_hardlinked_file_is_not_modified_in_place(self, engine, tmp_path):
+        """目标文件为 hardlink 时，替换不应影响另一个链接"""
+        original = tmp_path / "cache.smali"
+        original.write_text("old value", encoding="utf-8")
+        work = tmp_path / "work"
+        work.mkdir()
+        (work / "test.smali").hardlink_to(original)
+
+        rule = ScriptRule(target_path="test.smali", pattern="old", replacement="new")
+        result = engine.apply_script_rule(work, rule)
+
+        assert result.success is True
+        assert (work / "test.smali").read_text(encoding="utf-8") == "new value"
+        assert original.read_text(encoding="utf-8") == "old value"
+
+    def test_replacement_keeps_file_mode(self, engine, tmp_path):
+        """替换写入的新文件保留原文件的权限位"""
+        target = tmp_path / "run.sh"
+        target.write_text("echo old", encoding="utf-8")
+        target.chmod(0o755)
+
+        rule = ScriptRule(target_path="run.sh", pattern="old", replacement="newer")
+        assert engine.apply_script_rule(tmp_path, rule).success is True
+
+        assert target.read_text(encoding="utf-8") == "echo newer"
+        assert target.stat().st_mode & 0o777 == 0o755
+
+    def test_existing_tmp_sibling_not_clobbered(self, engine, tmp_path):
+        """反编译目录中已有的 <name>.tmp 文件不会被临时文件覆盖"""
+        (tmp_path / "a.xml").write_text("old", encoding="utf-8")
+        (tmp_path / "a.xml.tmp").write_text("keep", encoding="utf-8")
+
+        rule = ScriptRule(target_path="a.xml", pattern="old", replacement="newer")
+        assert engine.apply_script_rule(tmp_path, rule).success is True
+
+        assert (tmp_path / "a.xml").read_text(encoding="utf-8") == "newer"
+        assert (tmp_path / "a.xml.tmp").read_text(encoding="utf-8") == "keep"
+        assert sorted(p.name for p in tmp_path.iterdir()) == ["a.xml", "a.xml.tmp"]
+
+    def test_same_length_replacement_edits_unlinked_file_in_place(self, engine, tmp_path):
+        """等长替换且文件没有其它链接时原地修改，不创建新文件"""
+        target = tmp_path / "test.smali"
+        target.write_text("const v0, 0x7f010001\nconst v1, 0x7f010001", encoding="utf-8")
+        inode_before = target.stat().st_ino
+
+        rule = ScriptRule(
+            target_path="test.smali", pattern="0x7f010001", replacement="0x7f020002"
+        )
+        result = engine.apply_script_rule(tmp_path, rule)
+
+        assert result.success is True
+        assert "替换了 2 处" in result.message
+        assert target.read_text(encoding="utf-8") == "const v0, 0x7f020002\nconst v1, 0x7f020002"
+        assert target.stat().st_ino == inode_before
+
+
+class TestApplyScriptRulesBatch:
+    """同一文件的多条规则合并执行"""
+
+    def test_rules_applied_in_order_with_single_write(self, engine, tmp_path):
+        target = tmp_path / "strings.xml"
+        target.write_text("<string>OldName v1.0</string>", encoding="utf-8")
+
+        rules = [
+            ScriptRule(target_path="strings.xml", pattern="OldName", replacement="MidName"),
+            ScriptRule(target_path="strings.xml", pattern="MidName", replacement="NewName"),
+            ScriptRule(
+                target_path="strings.xml", pattern=r"v\d+\.\d+", replacement="v2.0", use_regex=True
+            ),
+            ScriptRule(target_path="strings.xml", pattern="missing", replacement="x"),
+        ]
+        with patch(
+            "app.services.rule_engine._write_atomic", wraps=rule_engine._write_atomic
+        ) as mock_write:
+            results = engine.apply_script_rules(tmp_path, rules)
+
+        assert mock_write.call_count == 1
+        assert [r.success for r in results] == [True, True, True, True]
+        assert "未修改" in results[3].message
+        assert target.read_text(encoding="utf-8") == "<string>NewName v2.0</string>"
+
+    def test_failing_rule_does_not_affect_others(self, engine, tmp_path):
+        target = tmp_path / "test.txt"
+        target.write_text("hello world", encoding="utf-8")
+
+        rules = [
+            ScriptRule(target_path="test.txt", pattern="(hello)", replacement=r"\2", use_regex=True),
+            ScriptRule(target_path="test.txt", pattern="world", replacement="there"),
+        ]
+        results = engine.apply_script_rules(tmp_path, rules)
+
+        assert results[0].success is False
+        assert results[1].success is True
+        assert target.read_text(encoding="utf-8") == "hello there"
+
+    def test_crlf_preserved_same_as_single_rules(self, engine, tmp_path):
+        """CRLF 换行在单条正则规则和合并执行两条路径下都原样保留"""
+        original = b"line1\r\nfoo bar\r\nend\r\n"
+        single = tmp_path / "single"
+        batch = tmp_path / "batch"
+        for d in (single, batch):
+            d.mkdir()
+            (d / "a.txt").write_bytes(original)
+
+        rules = [
+            ScriptRule(target_path="a.txt", pattern=r"f\w+", replacement="baz", use_regex=True),
+            ScriptRule(target_path="a.txt", pattern="bar", replacement="qux"),
+        ]
+        engine.apply_script_rule(single, rules[0])
+        assert (single / "a.txt").read_bytes() == b"line1\r\nbaz bar\r\nend\r\n"
+        engine.apply_script_rule(single, rules[1])
+        engine.apply_script_rules(batch, rules)
+
+        assert (batch / "a.txt").read_bytes() == b"line1\r\nbaz qux\r\nend\r\n"
+        assert (single / "a.txt").read_bytes() == (batch / "a.txt").read_bytes()
+
+    def test_missing_target(self, engine, tmp_path):
+        rules = [
+            ScriptRule(target_path="nope.txt", pattern="a", replacement="b"),
+            ScriptRule(target_path="nope.txt", pattern="c", replacement="d"),
+        ]
+        results = engine.apply_script_rules(tmp_path, rules)
+        assert all(not r.success and "不存在" in r.message for r in results)
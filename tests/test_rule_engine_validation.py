@@ -8,7 +8,7 @@ from app.models.schemas import ImageRule, ScriptRule
 from app.services.rule_engine import RuleEngine
 
 
-@pytest.fixture
+@pytest.fixture(scope="module")
 def engine():
     return RuleEngine()
 
@@ -105,6 +105,17 @@ class TestScriptRuleValidation:
         result = engine.validate_rules([rule])
         assert result.valid
 
+    def test_repeated_invalid_regex_reports_each_rule(self, engine):
+        rules = [
+            ScriptRule(
+                target_path=f"{i}.smali", pattern="[invalid(", replacement="x", use_regex=True
+            )
+            for i in range(3)
+        ]
+        result = engine.validate_rules(rules)
+        assert [e.rule_index for e in result.errors] == [0, 1, 2]
+        assert len({e.message for e in result.errors}) == 1
+
 
 # === ImageRule 验证 ===
 
@@ -129,6 +140,29 @@ class TestImageRuleValidation:
         assert result.errors[0].field == "image_data"
         assert "Base64" in result.errors[0].message
 
+    @pytest.mark.parametrize(
+        "data", ["QUI", "QU=I", "Q===", "QUI==", "QU===", "QU==QUJD", "=QUJD", "QUJé"]
+    )
+    def test_invalid_base64_length_or_padding(self, engine, data):
+        rule = ImageRule(target_path="res/icon.png", image_data=data)
+        result = engine.validate_rules([rule])
+        assert not result.valid
+        assert result.errors[0].field == "image_data"
+
+    @pytest.mark.parametrize("data", ["QUJD=", "QUJD===", "QUJDQUJD=="])
+    def test_excess_padding_after_complete_group_accepted(self, engine, data):
+        """完整分组之后多余的 '='，b64decode(validate=True) 同样接受"""
+        rule = ImageRule(target_path="res/icon.png", image_data=data)
+        assert engine.validate_rules([rule]).valid
+
+    def test_invalid_char_in_later_chunk(self, engine, monkeypatch):
+        monkeypatch.setattr("app.services.rule_engine._B64_CHUNK_CHARS", 8)
+        data = base64.b64encode(bytes(range(30))).decode()
+        rule = ImageRule(target_path="res/icon.png", image_data=data[:-8] + "!" + data[-7:])
+        assert not engine.validate_rules([rule]).valid
+        rule = ImageRule(target_path="res/icon.png", image_data=data)
+        assert engine.validate_rules([rule]).valid
+
 
 # === 批量验证 ===
 
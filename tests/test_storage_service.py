@@ -1,16 +1,17 @@
 """StorageService 单元测试"""
 
 import io
+import os
 import shutil
 import zipfile
 from datetime import datetime, timezone
 from pathlib import Path
-from unittest.mock import AsyncMock, MagicMock
+from unittest.mock import patch
 
 import pytest
 import pytest_asyncio
 
-from app.services.storage_service import StorageService
+from app.services.storage_service import FileTooLargeError, StorageService
 
 
 @pytest.fixture
@@ -25,20 +26,43 @@ def storage(tmp_data_dir: Path) -> StorageService:
     return StorageService(base_dir=str(tmp_data_dir))
 
 
-def _make_apk_bytes(manifest_content: bytes = b"<manifest/>") -> bytes:
-    """创建一个包含 AndroidManifest.xml 的最小有效 APK (ZIP) 文件"""
+def _build_apk_bytes(manifest_content: bytes) -> bytes:
+    """创建一个包含 AndroidManifest.xml 的最小有效 APK (ZIP) 文件（不压缩）"""
     buf = io.BytesIO()
-    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_STORED) as zf:
         zf.writestr("AndroidManifest.xml", manifest_content)
     return buf.getvalue()
 
 
-def _make_upload_file(content: bytes, filename: str = "test.apk") -> MagicMock:
-    """创建模拟的 UploadFile 对象"""
-    upload = AsyncMock()
-    upload.filename = filename
-    upload.read = AsyncMock(return_value=content)
-    return upload
+# 默认内容的 APK 在多个测试中使用，只构建一次
+_DEFAULT_APK_BYTES = _build_apk_bytes(b"<manifest/>")
+
+
+def _make_apk_bytes(manifest_content: bytes | None = None) -> bytes:
+    """返回最小有效 APK；未指定 manifest 内容时复用模块级的默认字节串"""
+    if manifest_content is None:
+        return _DEFAULT_APK_BYTES
+    return _build_apk_bytes(manifest_content)
+
+
+class _FakeUpload:
+    """UploadFile 的轻量替身：read(size) 从内存中按块返回内容，并记录调用次数"""
+
+    __slots__ = ("filename", "_buf", "read_calls")
+
+    def __init__(self, content: bytes, filename: str = "test.apk") -> None:
+        self.filename = filename
+        self._buf = io.BytesIO(content)
+        self.read_calls = 0
+
+    async def read(self, size: int = -1) -> bytes:
+        self.read_calls += 1
+        return self._buf.read(size)
+
+
+def _make_upload_file(content: bytes, filename: str = "test.apk") -> _FakeUpload:
+    """创建模拟的 UploadFile 对象（read(size) 按块返回内容）"""
+    return _FakeUpload(content, filename)
 
 
 # === 目录结构测试 ===
@@ -106,14 +130,70 @@ class TestSaveUpload:
         with pytest.raises(ValueError, match="AndroidManifest.xml"):
             await storage.save_upload(upload)
 
+    @pytest.mark.asyncio
+    async def test_reject_manifest_only_in_subdirectory(self, storage: StorageService):
+        """只有同名文件位于子目录中时不算有效 APK"""
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, "w") as zf:
+            zf.writestr("assets/AndroidManifest.xml", "<manifest/>")
+        upload = _make_upload_file(buf.getvalue())
+        with pytest.raises(ValueError, match="AndroidManifest.xml"):
+            await storage.save_upload(upload)
+
+    @pytest.mark.asyncio
+    async def test_accept_apk_with_archive_comment(self, storage: StorageService):
+        """带 ZIP 注释的 APK 应能找到 EOCD 记录并通过验证"""
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, "w") as zf:
+            zf.writestr("AndroidManifest.xml", "<manifest/>")
+            zf.comment = b"signed" * 100
+        upload = _make_upload_file(buf.getvalue())
+        apk_id = await storage.save_upload(upload)
+        assert storage.get_apk_path(apk_id).exists()
+
+    @pytest.mark.asyncio
+    async def test_reject_truncated_zip(self, storage: StorageService):
+        """截断的 ZIP（缺少 EOCD 记录）应被拒绝"""
+        upload = _make_upload_file(_make_apk_bytes()[:-30])
+        with pytest.raises(ValueError, match="ZIP"):
+            await storage.save_upload(upload)
+
     @pytest.mark.asyncio
     async def test_rejected_file_not_stored(self, storage: StorageService):
         """被拒绝的文件不应留在存储中"""
         upload = _make_upload_file(b"not a zip")
         with pytest.raises(ValueError):
             await storage.save_upload(upload)
-        # uploads 目录应为空
-        assert list(storage.uploads_dir.glob("*.apk")) == []
+        # uploads 目录应为空（也不留下 .part 临时文件）
+        assert os.listdir(storage.uploads_dir) == []
+
+    @pytest.mark.asyncio
+    async def test_non_zip_rejected_before_any_write(self, storage: StorageService):
+        """ZIP 魔数在第一块上检查，不是 ZIP 时不创建任何文件"""
+        upload = _make_upload_file(b"not a zip" * 1000)
+        with pytest.raises(ValueError, match="ZIP"):
+            await storage.save_upload(upload)
+        assert list(storage.uploads_dir.iterdir()) == []
+        assert upload.read_calls == 1
+
+    @pytest.mark.asyncio
+    async def test_save_large_apk_in_chunks(self, storage: StorageService):
+        """超过单个块大小的 APK 应被完整写入"""
+        apk_bytes = _make_apk_bytes(os.urandom(2 * storage.UPLOAD_CHUNK_SIZE))
+        assert len(apk_bytes) > storage.UPLOAD_CHUNK_SIZE
+        upload = _make_upload_file(apk_bytes)
+
+        apk_id = await storage.save_upload(upload)
+
+        assert storage.get_apk_path(apk_id).read_bytes() == apk_bytes
+
+    @pytest.mark.asyncio
+    async def test_reject_file_exceeding_max_size(self, storage: StorageService):
+        """超过 max_size 的文件应被拒绝且不留下任何文件"""
+        upload = _make_upload_file(_make_apk_bytes())
+        with pytest.raises(FileTooLargeError):
+            await storage.save_upload(upload, max_size=10)
+        assert list(storage.uploads_dir.iterdir()) == []
 
 
 # === 路径方法测试 ===
@@ -189,6 +269,20 @@ class TestListApks:
         assert len(result) == 1
         assert result[0]["apk_id"] == "valid"
 
+    def test_missing_uploads_dir(self, storage: StorageService):
+        """uploads 目录不存在时应返回空列表"""
+        storage.uploads_dir.rmdir()
+        assert storage.list_apks() == []
+
+    def test_ignores_apk_named_directories(self, storage: StorageService):
+        """应忽略以 .apk 结尾的目录和 .part 临时文件"""
+        (storage.uploads_dir / "dir.apk").mkdir()
+        (storage.uploads_dir / "pending.apk.part").write_bytes(b"data")
+        (storage.uploads_dir / "valid.apk").write_bytes(b"data")
+
+        result = storage.list_apks()
+        assert [r["apk_id"] for r in result] == ["valid"]
+
 
 # === delete_apk 测试 ===
 
@@ -215,6 +309,68 @@ class TestDeleteApk:
         await storage.delete_apk("apk1", [])
         assert not cache.exists()
 
+    @pytest.mark.asyncio
+    async def test_delete_nested_cache_keeps_symlink_targets(
+        self, storage: StorageService, tmp_path: Path
+    ):
+        """嵌套目录应被完整删除，符号链接只删除链接本身"""
+        outside = tmp_path / "outside"
+        outside.mkdir()
+        (outside / "keep.txt").write_text("keep")
+
+        cache = storage.get_cache_dir("apk1")
+        smali = cache / "decompiled" / "smali" / "com" / "example"
+        smali.mkdir(parents=True)
+        for i in range(50):
+            (smali / f"Class{i}.smali").write_text(".class")
+        (cache / "decompiled" / "link").symlink_to(outside)
+
+        await storage.delete_apk("apk1", [])
+
+        assert not cache.exists()
+        assert (outside / "keep.txt").read_text() == "keep"
+
+    @pytest.mark.asyncio
+    async def test_delete_continues_past_entries_removed_concurrently(
+        self, storage: StorageService
+    ):
+        """遍历中途被并发删除的条目应跳过，其余部分照常删除"""
+        cache = storage.get_cache_dir("apk1")
+        (cache / "decompiled" / "a").mkdir(parents=True)
+        (cache / "decompiled" / "b").mkdir()
+        for d in ("a", "b"):
+            for i in range(5):
+                (cache / "decompiled" / d / f"{i}.smali").write_text(".class")
+
+        real_unlink = os.unlink
+        raced = []
+
+        def racing_unlink(path, *args, **kwargs):
+            # 第一次删除时模拟另一个进程抢先删掉了这个文件
+            real_unlink(path, *args, **kwargs)
+            if not raced:
+                raced.append(path)
+                raise FileNotFoundError(path)
+
+        with patch("app.services.storage_service.os.unlink", side_effect=racing_unlink):
+            await storage.delete_apk("apk1", [])
+
+        assert raced
+        assert not cache.exists()
+
+    def test_purge_trash_removes_only_discarded_workdirs(self, storage: StorageService):
+        """purge_trash 只删除 {task_id}.trash.<hex> 残留目录"""
+        trash = storage.workspace_dir / "task1.trash.0a1b2c3d"
+        (trash / "decompiled").mkdir(parents=True)
+        (trash / "decompiled" / "Main.smali").write_text(".class")
+        live = storage.get_work_dir("task2")
+        live.mkdir()
+
+        storage.purge_trash()
+
+        assert not trash.exists()
+        assert live.is_dir()
+
     @pytest.mark.asyncio
     async def test_delete_associated_tasks(self, storage: StorageService):
         """应删除关联任务的输出和工作目录"""
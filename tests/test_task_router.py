@@ -1,5 +1,7 @@
 """Unit tests for task and download routes."""
 
+import asyncio
+import time
 from datetime import datetime, timezone
 from unittest.mock import AsyncMock, patch
 
@@ -18,11 +20,17 @@ def _clean_state(tmp_path):
     original_processor = state.processor
     original_meta = state.apk_metadata
     original_tasks = state.tasks
+    original_file_trees = state.file_tree_cache
+    original_tasks_by_apk = state.tasks_by_apk
+    original_queue = state.task_queue
 
     from app.services.storage_service import StorageService
     state.storage = StorageService(base_dir=str(tmp_path / "data"))
     state.apk_metadata = {}
     state.tasks = {}
+    state.file_tree_cache = {}
+    state.tasks_by_apk = {}
+    state.task_queue = asyncio.Queue()
 
     yield
 
@@ -30,13 +38,20 @@ def _clean_state(tmp_path):
     state.processor = original_processor
     state.apk_metadata = original_meta
     state.tasks = original_tasks
+    state.file_tree_cache = original_file_trees
+    state.tasks_by_apk = original_tasks_by_apk
+    state.task_queue = original_queue
 
 
-@pytest.fixture
+@pytest.fixture(scope="module")
 def client():
     return TestClient(app)
 
 
+# Seeded tasks never mutate their rule results, so they all share one instance.
+_OK_RULE_RESULT = RuleResult(rule_index=0, success=True, message="ok")
+
+
 def _seed_apk(apk_id: str = "abc123", cache_status: CacheStatus = CacheStatus.READY):
     """Insert a fake APK into shared state."""
     state.apk_metadata[apk_id] = {
@@ -49,19 +64,19 @@ def _seed_apk(apk_id: str = "abc123", cache_status: CacheStatus = CacheStatus.RE
 
 def _seed_completed_task(task_id: str, apk_id: str = "abc123", create_file: bool = True):
     """Insert a completed task into shared state and optionally create the output file."""
+    now = datetime.now(tz=timezone.utc)
     state.tasks[task_id] = {
         "apk_id": apk_id,
         "status": TaskStatus.COMPLETED,
-        "created_at": datetime.now(tz=timezone.utc),
-        "completed_at": datetime.now(tz=timezone.utc),
+        "created_at": now,
+        "completed_at": now,
         "download_url": f"/api/v1/download/{task_id}",
-        "rule_results": [RuleResult(rule_index=0, success=True, message="ok")],
+        "rule_results": [_OK_RULE_RESULT],
         "error": None,
     }
     if create_file:
-        output_path = state.storage.get_output_path(task_id)
-        output_path.parent.mkdir(parents=True, exist_ok=True)
-        output_path.write_bytes(b"fake apk content")
+        # StorageService already created the output directory.
+        state.storage.get_output_path(task_id).write_bytes(b"fake apk content")
 
 
 # ---- POST /api/v1/tasks ----
@@ -80,6 +95,29 @@ class TestCreateTask:
         assert "task_id" in body
         assert body["status"] == "pending"
         assert body["task_id"] in state.tasks
+        assert state.tasks_by_apk["abc123"] == [body["task_id"]]
+        assert state.task_queue.qsize() == 1
+
+    @patch.object(state, "processor")
+    def test_queued_task_is_processed_by_worker(self, mock_processor):
+        mock_processor.process_task = AsyncMock(return_value=[])
+        _seed_apk()
+
+        with TestClient(app) as client:  # runs lifespan, which starts the workers
+            resp = client.post("/api/v1/tasks", json={
+                "apk_id": "abc123",
+                "rules": [
+                    {"type": "script", "target_path": "a.txt", "pattern": "x", "replacement": "y"}
+                ],
+            })
+            task_id = resp.json()["task_id"]
+
+            deadline = time.monotonic() + 5
+            while state.tasks[task_id]["status"] != TaskStatus.COMPLETED:
+                assert time.monotonic() < deadline, "task was not processed"
+                time.sleep(0.01)
+
+        mock_processor.process_task.assert_awaited_once()
 
     def test_invalid_apk_id_returns_404(self, client):
         resp = client.post("/api/v1/tasks", json={
@@ -162,11 +200,12 @@ class TestGetTask:
 
     def test_failed_task_has_error(self, client):
         _seed_apk()
+        now = datetime.now(tz=timezone.utc)
         state.tasks["task-fail"] = {
             "apk_id": "abc123",
             "status": TaskStatus.FAILED,
-            "created_at": datetime.now(tz=timezone.utc),
-            "completed_at": datetime.now(tz=timezone.utc),
+            "created_at": now,
+            "completed_at": now,
             "download_url": None,
             "rule_results": [],
             "error": "recompile failed",
@@ -196,6 +235,16 @@ class TestDownloadTask:
         assert resp.headers["content-type"] == "application/vnd.android.package-archive"
         assert "test.apk" in resp.headers["content-disposition"]
         assert resp.content == b"fake apk content"
+        assert resp.headers["content-length"] == str(len(b"fake apk content"))
+
+    def test_download_supports_range_requests(self, client):
+        _seed_apk()
+        _seed_completed_task("range-task")
+
+        resp = client.get("/api/v1/download/range-task", headers={"Range": "bytes=0-3"})
+        assert resp.status_code == 206
+        assert resp.headers["accept-ranges"] == "bytes"
+        assert resp.content == b"fake"
 
     def test_download_non_completed_task_returns_404(self, client):
         _seed_apk()